@@ -2,72 +2,77 @@
 
 # -*- coding: utf-8 -*-
 
+import sys, os
+
+def headless():
+	"""True when the graphical interface can not start: PySide is missing,
+	or there is no display on an X11/Wayland system."""
+	if not sys.platform.startswith(('win', 'darwin')) and not (os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY')):
+		return True
+	try:
+		import PySide
+	except ImportError:
+		return True
+	return False
+
+if __name__ == "__main__" and (len(sys.argv) > 1 or headless()):
+	# command line arguments, or no GUI available: headless mode, do not load Qt at all
+	from aspectcsadjust_cli import main
+	sys.exit(main(sys.argv[1:]))
+
 from PySide.QtGui import *
 from PySide.QtCore import *
 from aspectcsadjust_ui import *
-import sys, os, time, csv, re
-if sys.version_info[0] >= 3:
-	from io import StringIO as sio
-else:
-	from StringIO import StringIO as sio
+from aspectcsadjust_core import *
+from aspectcsadjust_cache import opencache
+from aspectcsadjust_metrics import *
+import os, csv
 
 VERSION='1.2'
-UPDATE_DELAY=5
-
-RES_ROWLEN=45
-RES_NUM_COL=0
-RES_NAME_COL=1
-RES_LINE_COL=2
-RES_NAME2_COL=39
-RES_POS_COL=32
-RES_ABS_COL=18
-RES_DATE_COL=21
-RES_TIME_COL=22
-
-SAM_NAME_COL=0
-SAM_LINE_COL=1
-SAM_CONC_COL=2
-SAM_ABS_COL=3
-SAM_NAME2_COL=4
-
-REP_CONC_COL=3
-REP_ABS_COL=7
-
-""" User defined configuration folder """
-LOCAL_DIRECTORY='AspectCSAdjust'
-if sys.platform=='linux':
-	dir = os.path.join(os.environ['HOME'],LOCAL_DIRECTORY)
-	if not os.path.exists(dir):
-		os.makedirs(dir)
-	PERSIST_FILE=os.path.join(dir,'.persist')
-	DEFAULT_RESULT='./Result.csv'
-	DEFAULT_SAMPLE='./Defstd.alv'
-	DEFAULT_REPORT='./Report.csv'
-elif sys.platform=='win32':
-	dir = os.path.join(os.environ['APPDATA'],LOCAL_DIRECTORY)
-	if not os.path.exists(dir):
-		os.makedirs(dir)
-	PERSIST_FILE=os.path.join(dir,'.persist')
-	DEFAULT_RESULT='C:\Result.csv'
-	DEFAULT_SAMPLE='C:\Defstd.alv'
-	DEFAULT_REPORT='C:\Report.csv'
-else:
-	PERSIST_FILE='.persist'
-	DEFAULT_RESULT='./Result.csv'
-	DEFAULT_SAMPLE='./Defstd.alv'
-	DEFAULT_REPORT='./Report.csv'
+TABLE_HEADER=['No.', 'Nome', 'Elemento', 'Concentrazione', 'KAL', 'Diluizione', 'Posizione', 'Assorbanza', 'Data', 'Ora']
+TABLE_SAMPLE_ROWS=200	# rows measured to size the columns
 
 class MyTableModel(QAbstractTableModel): 
-	def __init__(self, data, header, parent=None, *args):
+	"""Report rows shown in the table.
+	The model lives as long as the window and update() applies only the
+	rows that changed; display strings are formatted once per row."""
+	def __init__(self, header, parent=None, *args):
 		QAbstractTableModel.__init__(self, parent, *args)
-		self.full_data = data
+		self.full_data = []
+		self.display = []
 		self.headerdata = header
+		self.locale = QLocale()
+
+	def format(self, row):
+		"""Display strings of a report row, as the default delegate shows them."""
+		return [self.locale.toString(value) if isinstance(value, float) else str(value) for value in row]
+
+	def update(self, start, rows):
+		"""Replace the rows from start on with rows."""
+		old = len(self.full_data)
+		start = min(start, old)
+		end = start + len(rows)
+		if end < old:
+			self.beginRemoveRows(QModelIndex(), end, old - 1)
+			del self.full_data[end:]
+			del self.display[end:]
+			self.endRemoveRows()
+		changed = min(old, end)
+		if start < changed:
+			self.full_data[start:changed] = rows[:changed-start]
+			self.display[start:changed] = [self.format(row) for row in rows[:changed-start]]
+			self.dataChanged.emit(self.index(start, 0), self.index(changed - 1, len(self.headerdata) - 1))
+		if end > old:
+			self.beginInsertRows(QModelIndex(), old, end - 1)
+			self.full_data.extend(rows[old-start:])
+			self.display.extend(self.format(row) for row in rows[old-start:])
+			self.endInsertRows()
     
 	def rowCount(self, parent):
 		return len(self.full_data) 
     
 	def columnCount(self, parent):
-		return len(self.full_data[0])
+		return len(self.headerdata)
     
 	def color(self, index):
 		if not index.isValid():
@@ -81,7 +86,7 @@ class MyTableModel(QAbstractTableModel):
 		if not index.isValid():
 			return None
 		if role == Qt.DisplayRole:
-			return self.full_data[index.row()][index.column()]
+			return self.display[index.row()][index.column()]
 		if role == Qt.BackgroundColorRole and index.column()==REP_CONC_COL:
 			return QBrush(Qt.green)
 		return None
@@ -94,189 +99,72 @@ class TimerSignal(QObject):
 	sigtimer = Signal(int)
 
 class ParseDataSignal(QObject):
-	sigdata = Signal(list)
+	sigdata = Signal(int, list)
+
+class CycleSignal(QObject):
+	sigcycle = Signal(float)
 
 class WorkingThread(QThread):
+	"""Runs the processing Pipeline, reporting through Qt signals."""
 	def __init__(self, parent = None):
 		QThread.__init__(self, parent)
+		self.pipeline = None
 		self.exiting = False
 		self.sig_timer = TimerSignal()
 		self.sig_data = ParseDataSignal()
+		self.sig_cycle = CycleSignal()
 		self.resultfile = ''
 		self.samplefile = ''
 		self.reportfile = ''
-		self.sampledata = []
-		self.output_data = []
-		self.old_output_data = []
-		self.data = []
-		self.old_data =[]
+
+	def getexiting(self):
+		return self._exiting or (self.pipeline is not None and self.pipeline.exiting)
+
+	def setexiting(self, value):
+		self._exiting = value
+		if self.pipeline is not None:
+			self.pipeline.exiting = value
+
+	exiting = property(getexiting, setexiting)
+
 	def run(self):
 		"""Thread callback"""
+		self.pipeline = Pipeline(self.resultfile, self.samplefile, self.reportfile)
+		self.pipeline.exiting = self._exiting
+		self.pipeline.ondata = self.sig_data.sigdata.emit
+		self.pipeline.ontimer = self.sig_timer.sigtimer.emit
+		self.pipeline.oncycle = lambda stats: self.sig_cycle.sigcycle.emit(stats.seconds)
+		self.pipeline.metrics = metricsfromenv()
 		self.checkfiles()
-		counter=0
-		global UPDATE_DELAY
-		if self.exiting==False:
-			self.parsesample()
-			self.parseresult()
-			self.processresult()
-		while self.exiting==False:
-			if counter>=UPDATE_DELAY:
-				counter=0
-				self.old_data = self.data
-				self.parseresult()
-				if self.old_data != self.data:
-					self.processresult()
-				else:
-					print("Results on disk did not change, skipping data processing!")
-			else:
-				counter=counter+1
-			self.sig_timer.sigtimer.emit(counter)
-			time.sleep(1)
+		if self.exiting==True:
+			return
+		self.pipeline.cache = opencache()
+		try:
+			profiled(self.pipeline.run)
+		except (csv.Error, StandardsError, IOError, OSError) as e:
+			print(e)
+			self.exiting=True
+		finally:
+			if self.pipeline.cache is not None:
+				self.pipeline.cache.close()
 
 	def checkfiles(self):
 		"""Check if result, sample and report files are OK."""
-		if not os.path.isfile(self.resultfile) or not os.path.isfile(self.samplefile):
+		if not self.pipeline.checkfiles():
 			self.exiting=True
+			return
 		try:
-			f = open(self.reportfile,'w')
-			with open(PERSIST_FILE,'w') as persist:
+			with open(self.reportfile,'w'):
+				pass
+			with open(persistfile(),'w') as persist:
 				persist.write(self.samplefile+'\n')
 				persist.write(self.reportfile+'\n')
 				persist.write(self.resultfile+'\n')
-		except:
+		except (IOError, OSError):
 			self.exiting=True
-		try:
-			f.close()
-		except:
-			pass
 		if self.exiting!=True:
 			print("Checking files: OK")
 
-	def parseresult(self):
-		"""Parse result csv file"""
-		self.data = []
-		with open(self.resultfile,'r') as result:
-			tmpf = sio()
-			while True:
-				line = result.readline()
-				if line == '': break
-				line = re.sub('[\0\200-\377]', '', line)
-				tmpf.write(line)
-			tmpf.seek(0)
-			reader = csv.reader(tmpf, delimiter=';')
-			try:
-				for row in reader:
-					# only bring in a row if it's the expected length. This will cut out freetext file headers.
-					# WORKAROUND to support the abnormal situation of 43 columns instead of 46!!!
-					if len(row)>0 and len(row)<46 and row[RES_NUM_COL].strip().isdigit():
-						r = row[0:32]
-						r.append('')
-						r.append('')
-						r.append('')
-						r += row[32:]
-						self.data.append(r)
-					elif len(row)>=46 and row[RES_NUM_COL].strip().isdigit():
-						row = row[0:45]
-						self.data.append(row)
-					else:
-						print('UNKNOWN ROW LENGTH:')
-						print(len(row))
-                                                if len(row) > 0:
-        					    print(row[RES_NUM_COL].strip().isdigit())
-						#print(row)
-			except csv.Error as e:
- 				sys.exit('file %s, line %d: %s' % (self.resultfile, reader.line_num, e))
-			tmpf.close()
-	
-	def processresult(self):
-		"""Generate output reports in RAM based on latest result data"""
-		self.old_output_data = self.output_data
-		self.output_data = []
-		try:
-			# output_data format: ("Numero,Nome,Elemento,Concentrazione,KAL,Diluizione,Posizione,Assorbanza,Data,Ora")
-			for row in self.data:
-				self.output_data.append([row[RES_NUM_COL],row[RES_NAME_COL],row[RES_LINE_COL].strip("1234567890 "),0,' ',row[RES_NAME2_COL],row[RES_POS_COL],row[RES_ABS_COL],row[RES_DATE_COL],row[RES_TIME_COL]])
-				data_upto_here = list(self.data[0:len(self.output_data)])
-				
-				# parse back the results to look for the latest (first when going back) standard (i.e. line whose name is in the standards list) whose LINE matches this result's LINE (except for numbers)
-				rrow_is_also_current_row=True
-				current_row_is_standard=False
-				standard_found=False
-				standard_conc=0
-				standard_abs=1
-				standard_dilut=1
-				row_stripped_line=row[RES_LINE_COL].strip("1234567890 ")
-				for rrow in reversed(data_upto_here):
-					for standardrow in self.sampledata:
-						if rrow[RES_NAME_COL].strip()==standardrow[SAM_NAME_COL].strip():
-							if rrow_is_also_current_row==True:	# the current row is a standard, we can skip the rest of the outer loop, too.
-								current_row_is_standard=True
-								#print ("STANDARD: no."+rrow[RES_NUM_COL])
-								break
-							if row_stripped_line==rrow[RES_LINE_COL].strip("1234567890 "): # we found the standard to use!
-								for nest_stdrow in self.sampledata:
-									if row_stripped_line==nest_stdrow[SAM_LINE_COL].strip() and standardrow[SAM_NAME_COL].strip()==nest_stdrow[SAM_NAME_COL].strip():
-										standard_conc=float(nest_stdrow[SAM_CONC_COL])
-										break
-								standard_abs=float(rrow[RES_ABS_COL])
-								if(rrow[RES_NAME2_COL].strip()!=''):
-									standard_dilut=float(rrow[RES_NAME2_COL])
-								standard_found=True
-								#print("MATCH: no."+rrow[RES_NUM_COL]+" CONC="+str(standard_conc)+" ABS="+str(standard_abs)+" DIL="+str(standard_dilut))
-								break
-					rrow_is_also_current_row=False  #ok, the current row is not a standard.
-					if current_row_is_standard or standard_found==True:
-						break
-				# the current row is a regular sample and we found the latest matching standard, compute the new concentration!
-				if standard_found==True:
-					if standard_abs == 0:
-						a = 0
-					else:
-						a = ( standard_conc * float(row[RES_ABS_COL]) ) / standard_abs
-					try:
-						b = float(row[RES_NAME2_COL]) / standard_dilut
-					except:
-						b = 0   # handles the case were input result file has rows with empty NAME2
-					#print("computing ("+str(standard_conc) +" * "+row[RES_ABS_COL]+") / "+str(standard_abs)+" * ("+ row[RES_NAME2_COL]+" / "+str(standard_dilut)+")")
-					self.output_data[-1][REP_CONC_COL]= a * b
-					#print self.output_data[-1][0]
-		except:
-			print("Parsing error. Wrong input file format?")
-			self.exiting=True
-			print("attempting: ("+str(standard_conc) +" * "+row[RES_ABS_COL]+") / "+str(standard_abs)+" * ("+ row[RES_NAME2_COL]+" / "+str(standard_dilut)+")")
-			raise
-					
-		print("records in/out: "+str(len(self.data))+"/"+str(len(self.output_data)))
-		self.sig_data.sigdata.emit(self.output_data)
-		if self.output_data != self.old_output_data:
-			self.generatereport(self.output_data)
-		else:
-			print("Same data, not regenerating csv report file")
-
-	def parsesample(self):
-		"""Parse sample csv file"""
-		self.sampledata = []
-		with open(self.samplefile,'r') as samples:
-			reader = csv.reader(samples)
-			for row in reader:
-				self.sampledata.append(row)
-	
-	def generatereport(self, data):
-		"""Dump report to disk in csv format"""
-		try:
-			if sys.version_info >= (3,0,0):
-				report = open(self.reportfile, 'w', newline='')
-			else:
-				report = open(self.reportfile, 'wb')
-			writer = csv.writer(report, delimiter=';', quotechar='"', quoting=csv.QUOTE_ALL)
-			for row in data:
-				writer.writerow(row)
-			print("generated report!")
-		except csv.Error as e:
-			sys.exit('file %s, line %d: %s' % (self.resultfile, writer.line_num, e))
-		finally:
-			report.close()
-
 class AspectCSAdjust(QtGui.QMainWindow, Ui_MainWindow):
 	def __init__(self, parent=None):
 		super(AspectCSAdjust, self).__init__(parent)
@@ -287,18 +175,28 @@ class AspectCSAdjust(QtGui.QMainWindow, Ui_MainWindow):
 		self.setWindowTitle('AspectCSAdjust v.'+VERSION)
 		self.setWindowIcon(QtGui.QIcon('resources/icon128x128.png'))
 		self.thread = WorkingThread()
+		self.closing = False
 		self.thread.started.connect(self.thread_started)
 		self.thread.finished.connect(self.thread_finished)
 		self.thread.terminated.connect(self.thread_terminated)
 		self.thread.sig_timer.sigtimer.connect(self.updatetimer)
 		self.thread.sig_data.sigdata.connect(self.filltable)
+		self.thread.sig_cycle.sigcycle.connect(self.updatelatency)
+		self.labelLatency = QtGui.QLabel(self.centralwidget)
+		self.labelLatency.setAlignment(Qt.AlignCenter)
+		self.verticalLayout_2.insertWidget(1, self.labelLatency)
+		self.model = MyTableModel(TABLE_HEADER, self)
+		self.tableView.setModel(self.model)
+		self.tableView.horizontalHeader().setMinimumSectionSize(60)
+		self.tableView.verticalHeader().setDefaultSectionSize(self.tableView.fontMetrics().height() + 6)
+		self.columnwidths = [0] * len(TABLE_HEADER)
 		self.editResult.setReadOnly(True)
 		self.editSample.setReadOnly(True)
 		self.editReport.setReadOnly(True)
 	
 		try:
-			with open(PERSIST_FILE,'r') as persist:
-				print("Opened "+PERSIST_FILE)	
+			with open(persistfile(),'r') as persist:
+				print("Opened "+persistfile())	
 				self.thread.samplefile = persist.readline().strip('\n')
 				self.editSample.setText(self.thread.samplefile)
 				self.thread.reportfile = persist.readline().strip('\n')
@@ -329,11 +227,11 @@ class AspectCSAdjust(QtGui.QMainWindow, Ui_MainWindow):
 			self.editResult.setText(archive[0]) 
 
 	def selectSample(self):
-		"""Slot for select sample file."""
-		archive = self.filebrowser.getOpenFileName(self,'Select Sample CSV file','.','CSV file (*.csv *.alv)')
-		if archive[0] != '' and os.path.isfile(archive[0]):
-			self.thread.samplefile = archive[0]
-			self.editSample.setText(archive[0]) 
+		"""Slot for select sample file(s), several files are merged."""
+		archives = self.filebrowser.getOpenFileNames(self,'Select Sample CSV file(s)','.','CSV file (*.csv *.alv)')
+		if len(archives[0]) > 0 and all(os.path.isfile(f) for f in archives[0]):
+			self.thread.samplefile = os.pathsep.join(archives[0])
+			self.editSample.setText(self.thread.samplefile)
 
 	def selectReport(self):
 		"""Slot for select report file."""
@@ -345,10 +243,13 @@ class AspectCSAdjust(QtGui.QMainWindow, Ui_MainWindow):
 
 	def closeEvent(self, event):
 		"""Overlod of the actual closeEvent method.
-		Just to make sure to close the working thread on closure."""
-		self.thread.exiting=True
+		Just to make sure to close the working thread on closure:
+		the window closes again once the thread has finished."""
 		if self.thread.isRunning():
-			self.waitstatus('finished')
+			self.closing = True
+			self.thread.exiting=True
+			event.ignore()
+			return
 		event.accept()
 
 	def runcheck(self):
@@ -360,9 +261,12 @@ class AspectCSAdjust(QtGui.QMainWindow, Ui_MainWindow):
 
 	def thread_started(self):
 		print('started')
+		self.setuistate(False)
 	def thread_finished(self):
 		print('finished')
 		self.setuistate(True)
+		if self.closing:
+			self.close()
 	def thread_terminated(self):
 		self.setuistate(True)
 		print('terminated')
@@ -376,6 +280,7 @@ class AspectCSAdjust(QtGui.QMainWindow, Ui_MainWindow):
 	
 	def setuistate(self, Enable):
 		"""Enables or disables the UI"""
+		self.buttonStart.setEnabled(True)
 		if(Enable==True):
 			self.buttonStart.setText('Start')
 			self.buttonReport.setEnabled(True)
@@ -396,47 +301,56 @@ class AspectCSAdjust(QtGui.QMainWindow, Ui_MainWindow):
 	
 	def start(self):
 		"""Callback for start application.
-		Start thread and disable all fields."""
+		Start thread, the fields are disabled once it has started."""
 		if not self.checkfiles():
 			QMessageBox.warning(self, "Specify files.", "Please specify all files.")
 			return False
+		self.model.update(0, [])
 		self.thread.exiting=False
+		self.buttonStart.setEnabled(False)
 		self.thread.start()
-		self.waitstatus('running')
-		self.setuistate(False)
 		
 	def stop(self):
 		"""Callback for stop application.
-		Stop thread and re-enable all fields."""
+		Ask the thread to stop: the fields are re-enabled when it finishes."""
+		self.buttonStart.setEnabled(False)
 		self.thread.exiting=True
-		self.waitstatus('finished')
-		self.setuistate(True)
-
-	def waitstatus(self, status):
-		"""Blocking wait until the thread is started/finished."""
-		if status=='running':
-			while not self.thread.isRunning():
-				continue
-		elif status=='finished':
-			while not self.thread.isFinished():
-				continue
 
 	def updatetimer(self, value):
 		"""Update LCD display number [5, 4, 3, 2, 1, 0]."""
 		self.lcdNumber.display(value)
+
+	def updatelatency(self, seconds):
+		"""Show how long the last processing cycle took."""
+		self.labelLatency.setText('last cycle: %.0f ms' % (seconds * 1000))
 	
-	def filltable(self, data):
-		header = ['No.', 'Nome', 'Elemento', 'Concentrazione', 'KAL', 'Diluizione', 'Posizione', 'Assorbanza', 'Data', 'Ora']
-		nrows = len(data)
-		tm = MyTableModel(data, header, self)
-		self.tableView.setModel(tm)
-		self.tableView.horizontalHeader().setMinimumSectionSize(60)
-		self.tableView.resizeColumnsToContents()
-		self.tableView.resizeRowsToContents()
-		#self.tableView.horizontalHeader().setStretchLastSection(True)
-		#print(data)
+	def filltable(self, start, rows):
+		"""Slot receiving the report rows changed from start on."""
+		scrollbar = self.tableView.verticalScrollBar()
+		atbottom = scrollbar.value() == scrollbar.maximum()
+		self.model.update(start, rows)
+		self.fitcolumns(start, start + len(rows))
+		if atbottom and len(rows) > 0:
+			self.tableView.scrollToBottom()
+
+	def fitcolumns(self, start, end):
+		"""Widen the columns to fit a sample of the rows in [start, end),
+		instead of measuring every cell. Columns never shrink, so they do
+		not jump around while the table grows."""
+		metrics = self.tableView.fontMetrics()
+		step = max(1, (end - start) // TABLE_SAMPLE_ROWS)
+		sample = [self.model.display[i] for i in range(start, end, step)]
+		if end > start:
+			sample.append(self.model.display[end - 1])
+		header = self.tableView.horizontalHeader()
+		for col, title in enumerate(TABLE_HEADER):
+			width = max([header.fontMetrics().width(title)] + [metrics.width(row[col]) for row in sample]) + 12
+			if width > self.columnwidths[col]:
+				self.columnwidths[col] = width
+				header.resizeSection(col, width)
 
 if __name__ == "__main__":
+	setuplogging()
 	app = QtGui.QApplication(sys.argv)
 	window = AspectCSAdjust()
 	window.show()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+"""Batch processing of many result files (several instruments, archives).
+
+Jobs are (result, sample, report) triples, read from a manifest or found
+with a glob pattern, processed in parallel on a pool of processes."""
+
+import sys, os, csv, glob, time, logging
+from aspectcsadjust_core import *
+try:
+	from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+	ProcessPoolExecutor = None
+
+SAMPLE_NAME='Defstd.alv'
+REPORT_NAME='Report.csv'
+RESULT_NAME='Result.csv'
+
+def cpucount():
+	"""Number of cores this process may run on."""
+	if hasattr(os, 'sched_getaffinity'):
+		return len(os.sched_getaffinity(0))
+	import multiprocessing
+	return multiprocessing.cpu_count()
+
+def readmanifest(filename):
+	"""Jobs listed in a manifest file, one 'result,sample,report' per line.
+	Empty lines and lines starting with # are ignored; relative paths are
+	relative to the manifest."""
+	jobs = []
+	base = os.path.dirname(os.path.abspath(filename))
+	with open(filename, 'r') as manifest:
+		for n, row in enumerate(csv.reader(manifest)):
+			if len(row) == 0 or row[0].strip().startswith('#'):
+				continue
+			if len(row) != 3:
+				raise ValueError('file %s, line %d: expected result,sample,report' % (filename, n + 1))
+			result, sample, report = [os.path.join(base, f.strip()) for f in row]
+			sample = os.pathsep.join(os.path.join(base, f) for f in samplefiles(row[1].strip()))
+			jobs.append((result, sample, report))
+	return jobs
+
+def globjobs(pattern, samplefile=None):
+	"""Jobs for the result files matching pattern. The sample file defaults
+	to Defstd.alv and the report to Report.csv next to each result file
+	(<name>_Report.csv if the result file is not named Result.csv)."""
+	jobs = []
+	for resultfile in sorted(glob.glob(pattern)):
+		directory = os.path.dirname(resultfile)
+		if os.path.basename(resultfile).lower() == RESULT_NAME.lower():
+			reportfile = os.path.join(directory, REPORT_NAME)
+		else:
+			reportfile = os.path.splitext(resultfile)[0] + '_' + REPORT_NAME
+		jobs.append((resultfile, samplefile or os.path.join(directory, SAMPLE_NAME), reportfile))
+	return jobs
+
+def processjob(job):
+	"""Process one (result, sample, report) triple, never raises.
+	Return a dict with the job files, row count, elapsed seconds and the
+	error message (None on success)."""
+	resultfile, samplefile, reportfile = job
+	summary = {'result': resultfile, 'sample': samplefile, 'report': reportfile, 'rows': 0, 'seconds': 0.0, 'error': None}
+	started = time.time()
+	logging.disable(logging.INFO)	# keep the messages of the pipeline out of the summary
+	try:
+		pipeline = Pipeline(resultfile, samplefile, reportfile)
+		if not pipeline.checkfiles():
+			summary['error'] = 'missing input files or report not writable'
+		else:
+			summary['rows'] = streamreport(resultfile, loadstandards(samplefile), reportfile).last_rows
+	except Exception as e:
+		summary['error'] = '%s: %s' % (e.__class__.__name__, e)
+	finally:
+		logging.disable(logging.NOTSET)
+	summary['seconds'] = time.time() - started
+	return summary
+
+def runbatch(jobs, workers=None):
+	"""Process jobs in parallel, return their summaries in the jobs order."""
+	workers = workers or cpucount()
+	if ProcessPoolExecutor is None or workers == 1 or len(jobs) < 2:
+		return [processjob(job) for job in jobs]
+	summaries = []
+	with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+		futures = [executor.submit(processjob, job) for job in jobs]
+		for job, future in zip(jobs, futures):
+			try:
+				summaries.append(future.result())
+			except Exception as e:
+				# the worker process itself died
+				summaries.append({'result': job[0], 'sample': job[1], 'report': job[2], 'rows': 0, 'seconds': 0.0, 'error': '%s: %s' % (e.__class__.__name__, e)})
+	return summaries
+
+def printsummary(summaries, elapsed, out=sys.stdout):
+	"""Print one line per job and the totals, return the number of failures."""
+	failures = 0
+	for s in summaries:
+		if s['error'] is None:
+			out.write('OK     %8.3fs %8d rows  %s -> %s\n' % (s['seconds'], s['rows'], s['result'], s['report']))
+		else:
+			failures += 1
+			out.write('FAILED %8.3fs %8s       %s: %s\n' % (s['seconds'], '-', s['result'], s['error']))
+	rows = sum(s['rows'] for s in summaries)
+	out.write('%d jobs, %d failed, %d rows in %.3fs\n' % (len(summaries), failures, rows, elapsed))
+	return failures
+
+def batch(source, samplefile=None, workers=None):
+	"""Process the jobs of a manifest file or a glob pattern and print the
+	summary. Return the number of failed jobs."""
+	if os.path.isfile(source) and not source.lower().endswith('.csv'):
+		jobs = readmanifest(source)
+	else:
+		jobs = globjobs(source, samplefile)
+	started = time.time()
+	summaries = runbatch(jobs, workers)
+	return printsummary(summaries, time.time() - started)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark of the AspectCSAdjust pipeline stages on synthetic data.
+
+Usage: python aspectcsadjust_bench.py [--sizes 1000,10000,100000] [--repeat 3]
+                                      [--standards 0.1] [--workers N] [--output bench.json]
+
+For every size a synthetic Result.csv/Defstd.alv pair is generated and each
+stage (parse, parse_parallel with --workers processes, process, report, the
+whole streaming conversion and an incremental append cycle) is timed, best of --repeat runs, then run once
+more under tracemalloc for its peak memory. The results are printed as JSON so they can be compared between
+releases."""
+
+import sys, os, time, json, shutil, logging, tempfile, platform, argparse
+from aspectcsadjust_core import *
+from aspectcsadjust_synth import *
+from aspectcsadjust_batch import cpucount
+try:
+	import tracemalloc
+except ImportError:
+	tracemalloc = None
+
+APPEND_RATIO=0.01	# share of the rows appended in the incremental cycle
+
+class Quiet(object):
+	"""Context manager silencing the progress messages of the pipeline
+	(the aspectcsadjust logger), so their output is not timed."""
+	def __enter__(self):
+		self.log = logging.getLogger('aspectcsadjust')
+		self.level = self.log.level
+		self.log.setLevel(logging.CRITICAL)
+	def __exit__(self, *args):
+		self.log.setLevel(self.level)
+
+def measure(stage, repeat):
+	"""Run stage() repeat times; return (best seconds, peak bytes or None).
+	stage() is run once more with tracemalloc for the memory peak, so the
+	tracing overhead does not spoil the timings."""
+	best = None
+	for i in range(repeat):
+		with Quiet():
+			started = time.time()
+			stage()
+			elapsed = time.time() - started
+		best = elapsed if best is None else min(best, elapsed)
+	peak = None
+	if tracemalloc is not None:
+		tracemalloc.start()
+		try:
+			with Quiet():
+				stage()
+			peak = tracemalloc.get_traced_memory()[1]
+		finally:
+			tracemalloc.stop()
+	return best, peak
+
+def benchsize(nrows, tmpdir, repeat=3, std_ratio=0.1, workers=None):
+	"""Benchmark all the stages on a nrows synthetic result file."""
+	resultfile = os.path.join(tmpdir, 'Result.csv')
+	samplefile = os.path.join(tmpdir, 'Defstd.alv')
+	reportfile = os.path.join(tmpdir, 'Report.csv')
+	rows = resultrows(nrows, std_ratio=std_ratio)
+	writeresult(resultfile, rows)
+	writestandards(samplefile, standardrows())
+	standards = loadstandards(samplefile)
+	with Quiet():
+		data = readresult(resultfile)
+		output_data = StandardTracker(standards).processrows(data)
+	stages = {}
+
+	def parse():
+		ResultReader(resultfile).read()
+	def process():
+		StandardTracker(standards).processrows(data)
+	def report():
+		ReportWriter(reportfile).write(output_data)
+	stages['parse'] = parse
+	try:
+		from aspectcsadjust_parallel import parseranges
+		# every size is split between the workers, whatever PARALLEL_MIN_SIZE
+		stages['parse_parallel'] = lambda: parseranges(resultfile, os.path.getsize(resultfile), workers, minchunk=1)
+	except ImportError:
+		pass
+	stages['process'] = process
+	stages['report'] = report
+	stages['stream'] = lambda: streamreport(resultfile, standards, reportfile)
+
+	# one cycle of the running monitor: the instrument appended a few rows
+	split = nrows - max(1, int(nrows * APPEND_RATIO))
+	appendfile = os.path.join(tmpdir, 'Append.csv')
+	state = {}
+	def appendsetup():
+		writeresult(appendfile, rows[:split])
+		pipeline = Pipeline(appendfile, samplefile, os.path.join(tmpdir, 'AppendReport.csv'))
+		with Quiet():
+			pipeline.start()
+		writeresult(appendfile, rows[split:], append=True, seed=1)
+		state['pipeline'] = pipeline
+	def appendcycle():
+		state['pipeline'].update()
+
+	results = {'rows': nrows, 'bytes': os.path.getsize(resultfile), 'stages': {}}
+	for name in sorted(stages):
+		seconds, peak = measure(stages[name], repeat)
+		results['stages'][name] = {'seconds': round(seconds, 6), 'peak_bytes': peak, 'rows_per_second': round(nrows / seconds) if seconds else None}
+	best = None
+	peak = None
+	for i in range(repeat + 1):
+		appendsetup()
+		if i < repeat:
+			with Quiet():
+				started = time.time()
+				appendcycle()
+				elapsed = time.time() - started
+			best = elapsed if best is None else min(best, elapsed)
+		elif tracemalloc is not None:
+			tracemalloc.start()
+			with Quiet():
+				appendcycle()
+			peak = tracemalloc.get_traced_memory()[1]
+			tracemalloc.stop()
+	results['stages']['append_cycle'] = {'seconds': round(best, 6), 'peak_bytes': peak, 'appended_rows': nrows - split}
+	return results
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='Benchmark the AspectCSAdjust pipeline stages.')
+	parser.add_argument('--sizes', default='1000,10000,100000', help='comma separated result row counts (default: %(default)s)')
+	parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage, the best is kept (default: %(default)s)')
+	parser.add_argument('--standards', type=float, default=0.1, help='ratio of standard rows (default: %(default)s)')
+	parser.add_argument('--workers', type=int, default=cpucount(), help='processes of the parse_parallel stage (default: number of cores, %(default)s)')
+	parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+	args = parser.parse_args(argv)
+	tmpdir = tempfile.mkdtemp(prefix='aspectcsadjust')
+	try:
+		sizes = [benchsize(int(n), tmpdir, args.repeat, args.standards, args.workers) for n in args.sizes.split(',')]
+	finally:
+		shutil.rmtree(tmpdir)
+	results = {
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'repeat': args.repeat,
+		'standards_ratio': args.standards,
+		'cores': cpucount(),
+		'workers': args.workers,
+		'sizes': sizes,
+	}
+	text = json.dumps(results, indent=2, sort_keys=True)
+	if args.output:
+		with open(args.output, 'w') as f:
+			f.write(text + '\n')
+	else:
+		print(text)
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
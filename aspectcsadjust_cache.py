@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+"""Persistent cache of the processed result files.
+
+The state of a Pipeline (parsed rows, report rows, per line standards and
+the reader position) is kept in a SQLite database in the configuration
+folder, keyed by the result file path and the fingerprints of the standards
+files. A new session on the same result file resumes from the cached state
+and only parses what the instrument appended since then. The least
+recently used entries are evicted past CACHE_SIZE bytes."""
+
+import os, json, hashlib, pickle, time, zlib, logging
+from aspectcsadjust_core import configdir, samplefiles
+try:
+	import sqlite3
+except ImportError:
+	sqlite3 = None
+
+CACHE_NAME='cache.sqlite'
+CACHE_SIZE=256<<20	# bytes of cached state kept at most
+FINGERPRINT_BLOCK=1<<16
+CACHE_VERSION=1
+
+def cachefile():
+	"""File of the result cache database."""
+	return os.path.join(configdir(),CACHE_NAME)
+
+def fingerprint(filename, size=None):
+	"""(path, size, mtime, head, tail) of the first size bytes of filename
+	(the whole file by default): head and tail are the SHA-1 of the first and
+	last FINGERPRINT_BLOCK bytes. mtime is None when size is not the file size."""
+	st = os.stat(filename)
+	mtime = st.st_mtime
+	if size is None or size == st.st_size:
+		size = st.st_size
+	else:
+		mtime = None
+	with open(filename, 'rb') as f:
+		head = hashlib.sha1(f.read(min(size, FINGERPRINT_BLOCK))).hexdigest()
+		f.seek(max(0, size - FINGERPRINT_BLOCK))
+		tail = hashlib.sha1(f.read(min(size, FINGERPRINT_BLOCK))).hexdigest()
+	return (os.path.abspath(filename), size, mtime, head, tail)
+
+class ResultCache(object):
+	"""SQLite store of Pipeline states, see Pipeline.loadcache()."""
+	def __init__(self, filename=None, maxsize=CACHE_SIZE):
+		self.filename = filename or cachefile()
+		self.maxsize = maxsize
+		self.db = sqlite3.connect(self.filename, check_same_thread=False)
+		with self.db:
+			self.db.execute('PRAGMA auto_vacuum=FULL')
+			self.db.execute('CREATE TABLE IF NOT EXISTS entries (result TEXT, sample TEXT, fingerprint TEXT, version INTEGER, used REAL, state BLOB, PRIMARY KEY (result, sample))')
+
+	def close(self):
+		self.db.close()
+
+	def samplekey(self, samplefile):
+		return json.dumps([fingerprint(f) for f in samplefiles(samplefile)])
+
+	def load(self, resultfile, samplefile):
+		"""Cached state of resultfile processed with samplefile, or None.
+		The state is used only if the result file still starts with the bytes
+		cached: unchanged, or with rows appended since."""
+		result = os.path.abspath(resultfile)
+		sample = self.samplekey(samplefile)
+		row = self.db.execute('SELECT fingerprint, state FROM entries WHERE result=? AND sample=? AND version=?', (result, sample, CACHE_VERSION)).fetchone()
+		if row is None:
+			return None
+		cached = json.loads(row[0])
+		current = list(fingerprint(resultfile, cached[1]))
+		if current[1] != cached[1] or current[3:] != cached[3:] or (current[2] is not None and current[2] != cached[2]):
+			return None
+		with self.db:
+			self.db.execute('UPDATE entries SET used=? WHERE result=? AND sample=?', (time.time(), result, sample))
+		return pickle.loads(zlib.decompress(row[1]))
+
+	def store(self, resultfile, samplefile, state):
+		"""Cache state, describing the first state['offset'] bytes of
+		resultfile, then evict the least recently used entries."""
+		result = os.path.abspath(resultfile)
+		blob = zlib.compress(pickle.dumps(state, 2), 1)
+		with self.db:
+			self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)', (result, self.samplekey(samplefile), json.dumps(fingerprint(resultfile, state['offset'])), CACHE_VERSION, time.time(), sqlite3.Binary(blob)))
+			self.evict()
+
+	def evict(self):
+		"""Remove the least recently used entries past maxsize bytes,
+		the newest entry is always kept."""
+		total = 0
+		for rowid, size in self.db.execute('SELECT rowid, length(state) FROM entries ORDER BY used DESC').fetchall():
+			total += size
+			if total > self.maxsize and total != size:
+				self.db.execute('DELETE FROM entries WHERE rowid=?', (rowid,))
+
+def opencache(filename=None):
+	"""ResultCache in the configuration folder, None if it can not be used."""
+	if sqlite3 is None:
+		return None
+	try:
+		return ResultCache(filename)
+	except (sqlite3.Error, IOError, OSError) as e:
+		logging.getLogger('aspectcsadjust').warning("Result cache disabled: "+str(e))
+		return None
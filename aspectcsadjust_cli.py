@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""Headless command line interface of AspectCSAdjust.
+
+Usage: python -m aspectcsadjust [--once | --watch] [-r RESULT] [-s SAMPLE] [-o REPORT]
+       python -m aspectcsadjust --once -j JOBS [-r RESULT] [-s SAMPLE] [-o REPORT]
+       python -m aspectcsadjust --serve [SOCKET|PORT] [-r RESULT] [-s SAMPLE] [-o REPORT]
+       python -m aspectcsadjust --batch MANIFEST|PATTERN [-s SAMPLE] [-j JOBS]
+
+Without any argument aspectcsadjust.py starts the graphical interface; it
+runs --once with the default files only when PySide or a display is missing."""
+
+import sys, os, csv, logging, argparse
+from aspectcsadjust_core import *
+from aspectcsadjust_batch import batch
+from aspectcsadjust_cache import opencache
+from aspectcsadjust_metrics import *
+from aspectcsadjust_sinks import opensink
+
+def parseargs(argv):
+	parser = argparse.ArgumentParser(prog='aspectcsadjust', description='Adjust Aspect CS result concentrations without the graphical interface.')
+	mode = parser.add_mutually_exclusive_group()
+	mode.add_argument('--once', action='store_true', help='process the result file once and exit (default)')
+	mode.add_argument('--watch', action='store_true', help='keep processing the result file as it changes')
+	mode.add_argument('--serve', metavar='SOCKET|PORT', nargs='?', const='', help='watch the result file and serve the report rows to local clients (JSON-lines) on a Unix socket, by default %s in the configuration folder, or on a localhost port; Python 3 only' % 'aspectcsadjust.sock')
+	mode.add_argument('--batch', metavar='SOURCE', help='process in parallel the jobs of a manifest file (result,sample,report per line) or of the result files matching a glob pattern')
+	parser.add_argument('-r', '--result', default=DEFAULT_RESULT, help='result csv file (default: %(default)s)')
+	parser.add_argument('-s', '--sample', help='standards file, or several separated by %r, the first listing a standard wins (default: %s, in batch mode Defstd.alv next to each result file)' % (os.pathsep, DEFAULT_SAMPLE))
+	parser.add_argument('-o', '--report', default=DEFAULT_REPORT, help='report csv file to write (default: %(default)s)')
+	parser.add_argument('-e', '--export', metavar='FILE', action='append', default=[], help='also export the report to FILE, in the format of its extension: .jsonl, .sqlite/.db, .parquet/.arrow (pyarrow), .csv; can be repeated')
+	parser.add_argument('-i', '--interval', type=int, default=UPDATE_DELAY, help='seconds between checks of the result file when no change is notified (default: %(default)s)')
+	parser.add_argument('--no-cache', dest='cache', action='store_false', help='do not resume from (nor save to) the result cache of the configuration folder')
+	parser.add_argument('-j', '--jobs', type=int, default=None, help='parallel batch jobs (default: number of cores); in the other modes, processes parsing a large result file from the start (default: 1)')
+	parser.add_argument('-v', '--verbose', action='store_true', help='log every cycle and the dropped result rows')
+	parser.add_argument('--metrics', metavar='FILE', default=os.environ.get(METRICS_ENV), help='append the timings and counters of every cycle to a JSON-lines file (default: $%s)' % METRICS_ENV)
+	parser.add_argument('--profile', metavar='FILE', default=os.environ.get(PROFILE_ENV), help='run under cProfile and save the statistics to FILE (default: $%s)' % PROFILE_ENV)
+	return parser.parse_args(argv)
+
+def main(argv):
+	"""Command line entry point, return the process exit status."""
+	args = parseargs(argv)
+	setuplogging(logging.DEBUG if args.verbose else logging.INFO)
+	return profiled(lambda: run(args), args.profile)
+
+def run(args):
+	"""Run the mode selected by the parsed arguments."""
+	if args.batch:
+		try:
+			failures = batch(args.batch, args.sample, args.jobs)
+		except (ValueError, IOError, OSError) as e:
+			sys.stderr.write('%s\n' % e)
+			return 2
+		return 1 if failures else 0
+	if args.sample is None:
+		args.sample = DEFAULT_SAMPLE
+	pipeline = Pipeline(args.result, args.sample, args.report)
+	pipeline.reader.workers = args.jobs or 1
+	if args.metrics:
+		pipeline.metrics = MetricsLog(args.metrics)
+	try:
+		pipeline.sinks = [opensink(filename) for filename in args.export]
+	except (ValueError, ImportError, IOError, OSError) as e:
+		sys.stderr.write('%s\n' % e)
+		return 2
+	if not pipeline.checkfiles():
+		sys.stderr.write('Can not use the files: check that %s and %s exist and %s is writable\n' % (args.result, args.sample, args.report))
+		return 2
+	if args.cache and (args.watch or args.serve is not None):
+		pipeline.cache = opencache()
+	try:
+		if args.watch:
+			pipeline.run(args.interval)
+		elif args.serve is not None:
+			if sys.version_info < (3, 7):
+				sys.stderr.write('The service mode needs Python 3.7 or later\n')
+				return 2
+			from aspectcsadjust_service import serve
+			serve(pipeline, args.serve, args.interval)
+		elif pipeline.sinks or pipeline.reader.workers > 1:
+			pipeline.start()
+		else:
+			stats = Stats('once')
+			with stats.timer('sample'):
+				standards = loadstandards(args.sample)
+			writer = streamreport(args.result, standards, args.report, stats, pipeline.metrics)
+			print("generated report! ("+str(writer.last_rows)+" rows, "+str(writer.last_bytes)+" bytes, crc32 %08x)" % writer.checksum)
+	except KeyboardInterrupt:
+		pass
+	except (csv.Error, StandardsError, IOError, OSError, ImportError) as e:
+		sys.stderr.write('%s\n' % e)
+		return 1
+	finally:
+		for sink in pipeline.sinks:
+			sink.close()
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,1169 @@
+# -*- coding: utf-8 -*-
+
+"""Qt-free parsing and concentration logic of AspectCSAdjust."""
+
+import sys, os, io, csv, stat, time, zlib, hashlib, tempfile, logging, threading
+from itertools import islice
+from contextlib import contextmanager
+if sys.version_info[0] >= 3:
+	intern = sys.intern
+from aspectcsadjust_watch import FileWatcher
+from aspectcsadjust_metrics import Stats
+if sys.version_info[0] >= 3:
+	from io import StringIO as sio
+else:
+	from StringIO import StringIO as sio
+
+RES_ROWLEN=45
+RES_NUM_COL=0
+RES_NAME_COL=1
+RES_LINE_COL=2
+RES_NAME2_COL=39
+RES_POS_COL=32
+RES_ABS_COL=18
+RES_DATE_COL=21
+RES_TIME_COL=22
+
+SAM_NAME_COL=0
+SAM_LINE_COL=1
+SAM_CONC_COL=2
+SAM_ABS_COL=3
+SAM_NAME2_COL=4
+
+REP_NUM_COL=0
+REP_CONC_COL=3
+REP_ABS_COL=7
+
+UPDATE_DELAY=5
+REPORT_BATCH=1000
+STREAM_BLOCK=1<<20
+CANCEL_ROWS=10000	# rows computed between two checks for cancellation
+PARALLEL_MIN_SIZE=32<<20	# smallest file parsed by several processes
+PREFIX_BLOCK=1<<16	# bytes checked at both ends of the parsed part when the file grows
+REPLACE_RETRIES=10	# attempts to replace a file held open by another program (Windows)
+REPLACE_DELAY=0.2	# seconds between two attempts
+
+""" User defined configuration folder """
+LOCAL_DIRECTORY='AspectCSAdjust'
+if sys.platform=='win32':
+	DEFAULT_RESULT='C:\\Result.csv'
+	DEFAULT_SAMPLE='C:\\Defstd.alv'
+	DEFAULT_REPORT='C:\\Report.csv'
+else:
+	DEFAULT_RESULT='./Result.csv'
+	DEFAULT_SAMPLE='./Defstd.alv'
+	DEFAULT_REPORT='./Report.csv'
+
+LINE_STRIP_CHARS="1234567890 "
+SANITIZE_DELETE=bytes(bytearray([0] + list(range(0x80, 0x100))))	# NUL and high bytes
+
+log = logging.getLogger('aspectcsadjust')
+
+def configdir():
+	"""Return the user configuration folder, creating it on first use."""
+	if sys.platform.startswith('linux'):
+		dir = os.path.join(os.environ['HOME'],LOCAL_DIRECTORY)
+	elif sys.platform=='win32':
+		dir = os.path.join(os.environ['APPDATA'],LOCAL_DIRECTORY)
+	else:
+		return ''
+	if not os.path.exists(dir):
+		os.makedirs(dir)
+	return dir
+
+def persistfile():
+	"""File storing the last used sample, report and result files."""
+	return os.path.join(configdir(),'.persist')
+
+def stripline(line):
+	"""Remove wavelength/line numbers from a result element line."""
+	return line.strip(LINE_STRIP_CHARS)
+
+def normalizeresult(row):
+	"""Return the result row padded/truncated to the standard layout,
+	or None if the row is not a measurement (i.e. freetext header)."""
+	# only bring in a row if it's the expected length. This will cut out freetext file headers.
+	# WORKAROUND to support the abnormal situation of 43 columns instead of 46!!!
+	if len(row)>0 and len(row)<46 and row[RES_NUM_COL].strip().isdigit():
+		r = row[0:32]
+		r.append('')
+		r.append('')
+		r.append('')
+		r += row[32:]
+		return r
+	elif len(row)>=46 and row[RES_NUM_COL].strip().isdigit():
+		return row[0:45]
+	log.debug('UNKNOWN ROW LENGTH: %d %s', len(row), len(row) > 0 and row[RES_NUM_COL].strip().isdigit())
+	return None
+
+def tofloat(value):
+	"""float(value), or None if value is not a number."""
+	try:
+		return float(value)
+	except ValueError:
+		return None
+
+class ResultRow(object):
+	"""Compact result row holding only the columns the report uses.
+
+	num, name, line, name2, pos, absorbance, date and time are the raw
+	strings copied to the report; the values needed by the computation are
+	converted once: stdname (stripped name), element (stripped, interned
+	element line), absvalue and dilvalue (floats, None if not a number).
+	Indexing with the RES_*_COL constants gives the raw strings."""
+	__slots__ = ('num', 'name', 'line', 'name2', 'pos', 'absorbance', 'date', 'time', 'stdname', 'element', 'absvalue', 'dilvalue')
+	COLUMNS = {RES_NUM_COL: 'num', RES_NAME_COL: 'name', RES_LINE_COL: 'line', RES_NAME2_COL: 'name2', RES_POS_COL: 'pos', RES_ABS_COL: 'absorbance', RES_DATE_COL: 'date', RES_TIME_COL: 'time'}
+
+	def __init__(self, row):
+		"""row is a normalized result row (list of strings)."""
+		self.num = row[RES_NUM_COL]
+		self.name = row[RES_NAME_COL]
+		self.line = row[RES_LINE_COL]
+		self.name2 = row[RES_NAME2_COL]
+		self.pos = row[RES_POS_COL]
+		self.absorbance = row[RES_ABS_COL]
+		self.date = row[RES_DATE_COL]
+		self.time = row[RES_TIME_COL]
+		self.stdname = self.name.strip()
+		self.element = intern(stripline(self.line))
+		self.absvalue = tofloat(self.absorbance)
+		self.dilvalue = tofloat(self.name2)
+
+	def __getitem__(self, col):
+		return getattr(self, self.COLUMNS[col])
+
+	def __getstate__(self):
+		return tuple(getattr(self, name) for name in self.__slots__)
+
+	def __setstate__(self, state):
+		for name, value in zip(self.__slots__, state):
+			setattr(self, name, value)
+
+	def __eq__(self, other):
+		return isinstance(other, ResultRow) and self.__getstate__() == other.__getstate__()
+
+	def __ne__(self, other):
+		return not self.__eq__(other)
+
+	__hash__ = None
+
+def shortrowerror(line_num):
+	"""csv.Error for a row too short to hold all the used columns: the
+	parsing loops build ResultRow objects directly and turn the IndexError
+	into this, once around the loop."""
+	return csv.Error('line %d: expected at least %d columns' % (line_num, RES_NAME2_COL + 1))
+
+def cleanbytes(data):
+	"""Drop the NUL and high bytes of raw result bytes, in one C pass."""
+	return data.translate(None, SANITIZE_DELETE)
+
+def asciitext(data, end=None):
+	"""Text of the first end bytes (all by default) of cleaned data,
+	decoded without copying the bytes first on Python 3."""
+	if end is None:
+		end = len(data)
+	if sys.version_info[0] >= 3:
+		return str(memoryview(data)[:end], 'ascii')
+	return data[:end].decode('ascii')
+
+def sanitize(data):
+	"""Decode raw result bytes and drop NUL and high characters."""
+	return asciitext(cleanbytes(data))
+
+def splitlines(text):
+	"""Iterate over the lines of text as over a file opened in text mode."""
+	if sys.version_info[0] >= 3:
+		return io.StringIO(text, newline=None)
+	return text.splitlines(True)
+
+def iterresultlines(filename, blocksize=STREAM_BLOCK, stats=None):
+	"""Sanitized lines of the result file, read in blocks of blocksize bytes.
+	The bytes read are counted in stats, if given."""
+	partial = b''
+	with open(filename, 'rb') as result:
+		while True:
+			block = result.read(blocksize)
+			if not block:
+				break
+			if stats is not None:
+				stats.count('bytes_read', len(block))
+			block = partial + cleanbytes(block)
+			end = block.rfind(b'\n') + 1
+			partial = block[end:]
+			for line in splitlines(asciitext(block, end)):
+				yield line
+	if partial:
+		for line in splitlines(asciitext(partial)):
+			yield line
+
+def iterresultrows(lines):
+	"""ResultRow objects of an iterable of sanitized lines.
+	Raises csv.Error."""
+	reader = csv.reader(lines, delimiter=';')
+	try:
+		for row in reader:
+			r = normalizeresult(row)
+			if r is not None:
+				yield ResultRow(r)
+	except csv.Error as e:
+		raise csv.Error('line %d: %s' % (reader.line_num, e))
+	except IndexError:
+		raise shortrowerror(reader.line_num)
+
+class ResultReader(object):
+	"""Incremental reader of the result csv file.
+
+	The instrument only appends to the file, so the reader remembers the byte
+	offset of what it has already parsed and the last (unterminated) line.
+	The whole file is read again when it shrinks or is replaced, or when the
+	part already parsed changed: edited in place or copied over. When the
+	file grew, only its first and last PREFIX_BLOCK bytes before offset are
+	checked, so an append costs O(appended bytes); when it changed at the
+	same size, the CRC-32 of all the bytes before offset is. With stats
+	(a Stats) set, read() adds its timings and row counts to it. With
+	cancelled (a threading.Event) set, read() raises Cancelled between two
+	blocks and the next read() starts over. With workers > 1, a full parse
+	of a file of PARALLEL_MIN_SIZE bytes or more is split between that many
+	processes (aspectcsadjust_parallel)."""
+	def __init__(self, filename):
+		self.filename = filename
+		self.stats = None
+		self.cancelled = None
+		self.workers = 1
+		self.reset()
+
+	def reset(self):
+		"""Forget the current position, next read will parse the whole file."""
+		self.ident = None
+		self.offset = 0
+		self.crc = 0	# CRC-32 of the bytes before offset
+		self.window = None	# windowcrc() at the last read
+		self.stat = None	# (size, mtime) of the file at the last read
+		self.partial = b''
+		self.line_num = 0
+		self.dropped = 0
+		self.pending = []
+
+	def parselines(self, lines, minlength=0):
+		"""ResultRow objects of complete csv lines, ignoring the rows with
+		less than minlength columns. Raises csv.Error."""
+		data = []
+		dropped = 0
+		reader = csv.reader(lines, delimiter=';')
+		try:
+			for row in reader:
+				r = normalizeresult(row)
+				if r is None:
+					dropped += 1
+				elif len(r) >= minlength:
+					data.append(ResultRow(r))
+		except csv.Error as e:
+			raise csv.Error('line %d: %s' % (self.line_num + reader.line_num, e))
+		except IndexError:
+			raise shortrowerror(self.line_num + reader.line_num)
+		self.line_num += reader.line_num
+		self.dropped = dropped
+		return data
+
+	def read(self, blocksize=STREAM_BLOCK):
+		"""Parse what was appended since the last call, blocksize bytes at
+		a time. Return (rows, reloaded): the new complete rows and whether
+		the file was parsed from the beginning. The row of a trailing
+		unterminated line, if any and complete, is kept apart in self.pending."""
+		stats = self.stats if self.stats is not None else Stats()
+		with stats.timer('read'):
+			st = os.stat(self.filename)
+			ident = (st.st_dev, st.st_ino)
+			sizetime = (st.st_size, st.st_mtime)
+			reloaded = False
+			if ident != self.ident or st.st_size < self.offset or (sizetime != self.stat and not self.unchanged(st.st_size, stats)):
+				if ident == self.ident:
+					log.info("Result file rewritten, parsing it again")
+				self.reset()
+				self.ident = ident
+				reloaded = True
+		self.stat = sizetime
+		if st.st_size == self.offset:
+			return [], reloaded
+		rows = []
+		if self.offset == 0 and self.workers > 1 and st.st_size >= PARALLEL_MIN_SIZE:
+			rows = self.readparallel(st.st_size, stats)
+		with open(self.filename, 'rb') as result:
+			result.seek(self.offset)
+			while True:
+				if self.cancelled is not None and self.cancelled.is_set():
+					self.reset()
+					raise Cancelled()
+				with stats.timer('read'):
+					block = result.read(blocksize)
+				if not block:
+					break
+				stats.count('bytes_read', len(block))
+				self.offset += len(block)
+				self.crc = zlib.crc32(block, self.crc) & 0xffffffff
+				# the partial line is kept cleaned: sanitizing is per byte
+				with stats.timer('sanitize'):
+					block = self.partial + cleanbytes(block)
+				end = block.rfind(b'\n') + 1
+				self.partial = block[end:]
+				with stats.timer('parse'):
+					rows.extend(self.parselines(splitlines(asciitext(block, end))))
+				stats.count('rows_dropped', self.dropped)
+		with stats.timer('read'):
+			self.window = self.windowcrc(stats)
+		stats.count('rows_parsed', len(rows))
+		with stats.timer('parse'):
+			# the instrument may be in the middle of writing the last line:
+			# only use it when it has all the columns
+			line_num = self.line_num
+			self.pending = self.parselines([sanitize(self.partial)], RES_ROWLEN) if self.partial else []
+			self.line_num = line_num
+		return rows, reloaded
+
+	def unchanged(self, size, stats):
+		"""Whether the bytes before offset still are those parsed: the
+		window at both ends when the file grew, all of them otherwise."""
+		if size > self.offset:
+			return self.windowcrc(stats) == self.window
+		return self.prefixcrc(stats) == self.crc
+
+	def prefixcrc(self, stats=None):
+		"""CRC-32 of the bytes before offset, as they are in the file now."""
+		crc = 0
+		with open(self.filename, 'rb') as f:
+			remaining = self.offset
+			while remaining > 0:
+				block = f.read(min(remaining, STREAM_BLOCK))
+				if not block:
+					break
+				crc = zlib.crc32(block, crc) & 0xffffffff
+				remaining -= len(block)
+		if stats is not None:
+			stats.count('bytes_read', self.offset - remaining)
+		return crc
+
+	def windowcrc(self, stats=None):
+		"""CRC-32 of the first and of the last PREFIX_BLOCK bytes before
+		offset, as they are in the file now."""
+		if self.offset == 0:
+			return 0, 0
+		with open(self.filename, 'rb') as f:
+			head = f.read(min(self.offset, PREFIX_BLOCK))
+			tail = head
+			if self.offset > PREFIX_BLOCK:
+				f.seek(self.offset - PREFIX_BLOCK)
+				tail = f.read(PREFIX_BLOCK)
+		if stats is not None:
+			stats.count('bytes_read', len(head) + (len(tail) if tail is not head else 0))
+		return zlib.crc32(head) & 0xffffffff, zlib.crc32(tail) & 0xffffffff
+
+	def readparallel(self, size, stats):
+		"""Parse the complete lines of the first size bytes in worker
+		processes and move past them. Return the rows, no rows if the file
+		has to be parsed serially."""
+		from aspectcsadjust_parallel import parseranges
+		try:
+			with stats.timer('parse'):
+				parsed = parseranges(self.filename, size, self.workers, self.cancelled)
+		except Cancelled:
+			self.reset()
+			raise
+		if parsed is None:
+			return []
+		rows, self.offset, self.line_num, dropped = parsed
+		with stats.timer('read'):
+			self.crc = self.prefixcrc(stats)
+		stats.count('bytes_read', self.offset)
+		stats.count('rows_dropped', dropped)
+		return rows
+
+def readresult(filename, workers=1):
+	"""Parse result csv file and return the list of ResultRow objects,
+	with workers processes for large files. Raises csv.Error on malformed files."""
+	reader = ResultReader(filename)
+	reader.workers = workers
+	rows, reloaded = reader.read()
+	return rows + reader.pending
+
+class StandardsError(ValueError):
+	"""Raised when the standards file can not be used."""
+	pass
+
+class Cancelled(Exception):
+	"""Raised when the processing is stopped from another thread."""
+	pass
+
+class Standards(object):
+	"""Standards (Defstd.alv) indexed for constant time lookups.
+
+	names holds the stripped standard names, conc maps (name, line) to the
+	nominal concentration; as in the file, the first occurrence wins."""
+	def __init__(self, rows=(), filename=''):
+		self.names = set()
+		self.conc = {}
+		for n, row in enumerate(rows):
+			if len(row) == 0:
+				continue
+			if len(row) <= SAM_CONC_COL:
+				raise StandardsError('file %s, line %d: expected at least %d columns' % (filename, n + 1, SAM_CONC_COL + 1))
+			name = row[SAM_NAME_COL].strip()
+			try:
+				conc = float(row[SAM_CONC_COL])
+			except ValueError:
+				raise StandardsError('file %s, line %d: invalid concentration %r' % (filename, n + 1, row[SAM_CONC_COL]))
+			self.names.add(name)
+			self.conc.setdefault((name, row[SAM_LINE_COL].strip()), conc)
+
+	def update(self, other):
+		"""Add the standards of other, keeping the concentrations already known."""
+		self.names |= other.names
+		for key, conc in other.conc.items():
+			self.conc.setdefault(key, conc)
+
+	def isstandard(self, name):
+		"""True if the (stripped) result name is listed in the standards."""
+		return name in self.names
+
+	def concentration(self, name, line):
+		"""Nominal concentration of standard name on element line (0 if unknown)."""
+		return self.conc.get((name, line), 0)
+
+def readsample(filename):
+	"""Parse sample (standards) csv file, raw rows"""
+	sampledata = []
+	with open(filename,'r') as samples:
+		reader = csv.reader(samples)
+		for row in reader:
+			sampledata.append(row)
+	return sampledata
+
+def samplefiles(samplefile):
+	"""The standards files of an os.pathsep separated list."""
+	return [f for f in samplefile.split(os.pathsep) if f != '']
+
+def loadstandards(samplefile):
+	"""Parse sample (standards) csv file(s, os.pathsep separated) into a
+	Standards index"""
+	return StandardsLibrary(samplefile).standards
+
+class StandardsLibrary(object):
+	"""Standards of several files merged into one Standards index.
+
+	A (name, line) concentration comes from the first file listing it, the
+	way the first occurrence wins inside a file. reload() parses again only
+	the files whose content changed."""
+	def __init__(self, samplefile):
+		self.filenames = samplefiles(samplefile)
+		self.files = {}	# filename -> (stat, SHA-1 of the content, Standards)
+		self.standards = Standards()
+		self.reload()
+
+	def reload(self):
+		"""Parse again the files that changed since the last call.
+		Return the set of element lines whose concentrations changed (empty
+		if nothing changed), or None if the standard names changed, which
+		may change any report row. Raises StandardsError, IOError, OSError."""
+		files = {}
+		changed = False
+		for filename in self.filenames:
+			st = os.stat(filename)
+			stat = (st.st_size, st.st_mtime, st.st_ino)
+			entry = self.files.get(filename)
+			if entry is not None and entry[0] == stat:
+				files[filename] = entry
+				continue
+			with open(filename, 'rb') as f:
+				digest = hashlib.sha1(f.read()).hexdigest()
+			if entry is not None and entry[1] == digest:
+				files[filename] = (stat, digest, entry[2])
+				continue
+			files[filename] = (stat, digest, Standards(readsample(filename), filename))
+			changed = True
+		self.files = files
+		if not changed:
+			return set()
+		old = self.standards
+		self.standards = Standards()
+		for filename in self.filenames:
+			self.standards.update(files[filename][2])
+		if old.names != self.standards.names:
+			return None
+		keys = set(old.conc) | set(self.standards.conc)
+		return set(line for name, line in keys if old.conc.get((name, line)) != self.standards.conc.get((name, line)))
+
+def adjustconcentration(standard_conc, standard_abs, standard_dilut, absorbance, dilution):
+	"""Compute the concentration of a sample from the governing standard.
+	absorbance and dilution are the sample values, None if not a number."""
+	if standard_abs == 0:
+		a = 0
+	elif absorbance is None:
+		raise ValueError('invalid absorbance')
+	else:
+		a = ( standard_conc * absorbance ) / standard_abs
+	if dilution is None or standard_dilut == 0:
+		b = 0   # handles the case were input result file has rows with empty NAME2
+	else:
+		b = dilution / standard_dilut
+	return a * b
+
+def standardvalues(standard):
+	"""Absorbance and dilution of a standard ResultRow (empty dilution is 1).
+	Raises ValueError if they are not numbers."""
+	if standard.absvalue is None:
+		raise ValueError('standard no. %s: invalid absorbance %r' % (standard.num, standard.absorbance))
+	if standard.dilvalue is not None:
+		return standard.absvalue, standard.dilvalue
+	if standard.name2.strip()!='':
+		raise ValueError('standard no. %s: invalid dilution %r' % (standard.num, standard.name2))
+	return standard.absvalue, 1
+
+class StandardTracker(object):
+	"""Resolve the standard of each result row in a single forward pass.
+
+	The governing standard of a sample is the latest standard row before it
+	whose stripped element line matches, so it is enough to remember the
+	latest standard row per stripped line while walking the results.
+	matched counts the samples that had a standard."""
+	def __init__(self, standards):
+		self.standards = standards
+		self.latest = {}
+		self.matched = 0
+
+	def reset(self):
+		"""Forget all the standards seen so far."""
+		self.latest = {}
+
+	def checkpoint(self):
+		"""Return a copy of the per line state, see restore()."""
+		return dict(self.latest)
+
+	def restore(self, state):
+		"""Go back to the state returned by checkpoint()."""
+		self.latest = dict(state)
+
+	def processrow(self, row):
+		"""Return the report row for the next result row (a ResultRow)."""
+		# output_data format: ("Numero,Nome,Elemento,Concentrazione,KAL,Diluizione,Posizione,Assorbanza,Data,Ora")
+		out = [row.num,row.name,row.element,0,' ',row.name2,row.pos,row.absorbance,row.date,row.time]
+		if self.standards.isstandard(row.stdname):
+			self.latest[row.element] = row
+			return out
+		standard = self.latest.get(row.element)
+		if standard is not None:
+			self.matched += 1
+			standard_conc = self.standards.concentration(standard.stdname, row.element)
+			standard_abs, standard_dilut = standardvalues(standard)
+			if standard_abs != 0 and row.absvalue is None:
+				raise ValueError('result no. %s: invalid absorbance %r' % (row.num, row.absorbance))
+			out[REP_CONC_COL] = adjustconcentration(standard_conc, standard_abs, standard_dilut, row.absvalue, row.dilvalue)
+		return out
+
+	def processrows(self, rows):
+		"""Return the report rows for a sequence of result rows."""
+		return [self.processrow(row) for row in rows]
+
+def hashrow(row, digest=1):
+	"""Return (hash, digest) of a report row: its 64 bits content hash
+	(CRC-32 and Adler-32 of its repr, so 0 and 0.0 differ) and the rolling
+	digest continued from the digest of the previous rows."""
+	data = repr(row)
+	if not isinstance(data, bytes):
+		data = data.encode('utf-8')
+	rowhash = (zlib.crc32(data) & 0xffffffff) << 32 | (zlib.adler32(data) & 0xffffffff)
+	digest = (zlib.crc32(data, digest >> 32) & 0xffffffff) << 32 | (zlib.adler32(data, digest & 0xffffffff) & 0xffffffff)
+	return rowhash, digest
+
+class ChangeDetector(object):
+	"""Change detection on a list of rows by content hash.
+
+	Only the hash of every row and the rolling digest of the rows up to it
+	are kept, not the rows: update() tells in O(new rows) whether the list
+	is unchanged, got rows appended or changed from a given row. Equal
+	digests at row i mean equal rows up to i."""
+	UNCHANGED = 'unchanged'
+	APPENDED = 'appended'
+	CHANGED = 'changed'
+
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		self.hashes = []
+		self.digests = []
+
+	def digest(self, n=None):
+		"""Digest of the first n rows (all the rows by default)."""
+		if n is None:
+			n = len(self.digests)
+		return self.digests[n-1] if n > 0 else 1
+
+	def update(self, rows, start=0):
+		"""Record rows as the new rows from start on, those before start
+		being unchanged. Return (status, index): index is the first
+		appended or changed row (the row count if unchanged)."""
+		old = self.hashes[start:]
+		del self.hashes[start:]
+		del self.digests[start:]
+		digest = self.digest()
+		changed = None
+		for i, row in enumerate(rows):
+			rowhash, digest = hashrow(row, digest)
+			if changed is None and (i >= len(old) or rowhash != old[i]):
+				changed = start + i
+			self.hashes.append(rowhash)
+			self.digests.append(digest)
+		if changed is None:
+			if len(self.hashes) < start + len(old):
+				return self.CHANGED, len(self.hashes)	# rows removed
+			return self.UNCHANGED, len(self.hashes)
+		if changed == start + len(old):
+			return self.APPENDED, changed
+		return self.CHANGED, changed
+
+def replacefile(src, dst):
+	"""Atomically rename src over dst. On Windows this fails while another
+	program has dst open: retry REPLACE_RETRIES times before raising."""
+	for attempt in range(REPLACE_RETRIES):
+		try:
+			if hasattr(os, 'replace'):
+				os.replace(src, dst)
+			else:
+				if sys.platform=='win32' and os.path.exists(dst):
+					os.remove(dst)
+				os.rename(src, dst)
+			return
+		except OSError:
+			if sys.platform!='win32' or attempt == REPLACE_RETRIES - 1:
+				raise
+			time.sleep(REPLACE_DELAY)
+
+def newfilemode(filename):
+	"""Permission bits for a file replacing filename: those of filename,
+	or those of a new file (0666 less the umask) if it does not exist."""
+	try:
+		return stat.S_IMODE(os.stat(filename).st_mode)
+	except OSError:
+		umask = os.umask(0)
+		os.umask(umask)
+		return 0o666 & ~umask
+
+@contextmanager
+def replacing(filename):
+	"""Yield the name of a new temporary file in the folder of filename.
+	When the block succeeds the file atomically replaces filename, with
+	the permissions of the file it replaces; otherwise it is removed."""
+	fd, tmpname = tempfile.mkstemp(prefix='.'+os.path.basename(filename), suffix='.tmp', dir=os.path.dirname(os.path.abspath(filename)))
+	os.close(fd)
+	try:
+		yield tmpname
+		# mkstemp creates the file readable by its owner only
+		os.chmod(tmpname, newfilemode(filename))
+		replacefile(tmpname, filename)
+	except:
+		if os.path.exists(tmpname):
+			os.remove(tmpname)
+		raise
+
+class ReportWriter(object):
+	"""Writer of the report csv file.
+
+	When the rows already on disk are unchanged only the new rows are
+	appended, otherwise the file is rewritten into a temporary file which
+	then replaces the report, so readers never see a half written file.
+	last_mode, last_rows and last_bytes describe the latest write(),
+	checksum is the CRC-32 of the whole report file.
+
+	This is the CSV report sink: every sink (see aspectcsadjust_sinks) has
+	the same write(data, start) and close() methods."""
+	def __init__(self, filename):
+		self.filename = filename
+		self.rows = None	# rows on disk, None if unknown
+		self.size = 0
+		self.checksum = 0
+		self.last_mode = ''
+		self.last_rows = 0
+		self.last_bytes = 0
+
+	def writerows(self, f, rows, checksum=0):
+		"""Write the rows of an iterable to the binary file f in batches.
+		Return (rows, bytes, checksum) written, checksum continuing the
+		given CRC-32."""
+		rows = iter(rows)
+		nrows = 0
+		written = 0
+		while True:
+			batch = list(islice(rows, REPORT_BATCH))
+			if not batch:
+				break
+			data = self.formatrows(batch)
+			f.write(data)
+			nrows += len(batch)
+			written += len(data)
+			checksum = zlib.crc32(data, checksum) & 0xffffffff
+		return nrows, written, checksum
+
+	def formatrows(self, rows):
+		"""Encoded text of a batch of report rows."""
+		buf = sio()
+		writer = csv.writer(buf, delimiter=';', quotechar='"', quoting=csv.QUOTE_ALL)
+		writer.writerows(rows)
+		data = buf.getvalue()
+		if not isinstance(data, bytes):
+			data = data.encode('utf-8')
+		return data
+
+	def rewrite(self, rows):
+		"""Replace the report with the rows of an iterable, atomically."""
+		self.last_mode = 'rewrite'
+		self.rows = None
+		with replacing(self.filename) as tmpname:
+			with open(tmpname, 'wb') as report:
+				self.last_rows, self.last_bytes, self.checksum = self.writerows(report, rows)
+		self.size = self.last_bytes
+		self.rows = self.last_rows
+
+	def write(self, data, start=0):
+		"""Bring the report in line with data, whose rows before start are
+		known to be on disk already."""
+		if self.rows is not None and start == self.rows and os.path.isfile(self.filename) and os.path.getsize(self.filename) == self.size:
+			self.last_mode = 'append'
+			with open(self.filename, 'ab') as report:
+				self.last_rows, self.last_bytes, self.checksum = self.writerows(report, data[start:], self.checksum)
+			self.size += self.last_bytes
+			self.rows = len(data)
+		else:
+			self.rewrite(data)
+
+	def close(self):
+		pass
+
+def streamreport(resultfile, standards, reportfile, stats=None, metrics=None):
+	"""Process a result file of any size in constant memory.
+
+	The rows flow through generators (block read -> sanitize -> csv split ->
+	normalize -> compute -> batched write), only the per line standards and
+	one write batch are kept. The report is replaced atomically at the end.
+	The conversion is one cycle: its timing and counters go to stats (a new
+	Stats by default), are logged and appended to metrics (a MetricsLog)
+	if set. Return the ReportWriter (rows, bytes and CRC-32 written).
+	Raises csv.Error naming the file and the line on malformed results."""
+	stats = stats if stats is not None else Stats('stream')
+	tracker = StandardTracker(standards)
+	writer = ReportWriter(reportfile)
+	rows = iterresultrows(iterresultlines(resultfile, stats=stats))
+	try:
+		with stats.timer('stream'):
+			writer.rewrite(tracker.processrow(row) for row in rows)
+	except csv.Error as e:
+		raise csv.Error('file %s, %s' % (resultfile, e))
+	stats.count('rows_parsed', writer.last_rows)
+	stats.count('rows_computed', writer.last_rows)
+	stats.count('standards_matched', tracker.matched)
+	stats.count('report_bytes', writer.last_bytes)
+	stats.finish()
+	log.info(stats.summary())
+	if metrics is not None:
+		try:
+			metrics.write(stats)
+		except (IOError, OSError) as e:
+			log.warning("Can not write the metrics file: "+str(e))
+	return writer
+
+class Pipeline(object):
+	"""The result -> report processing, independent from the user interface.
+
+	ondata(start, rows) is called when the report changed: the report rows
+	from start on are replaced by rows (those before start are unchanged).
+	ontimer(counter) is called at every tick of run(). Errors in the input files
+	are raised as csv.Error or StandardsError. Setting exiting (or cancel(),
+	from any thread) stops run() at once: waits are interrupted and the
+	parsing and processing check for it between blocks of rows, raising
+	Cancelled. With a cache
+	(aspectcsadjust_cache.ResultCache), start() resumes from the state of the
+	previous session on the same files and run() saves it when it stops.
+
+	The report goes to writer (the CSV report) and to the extra sinks
+	(aspectcsadjust_sinks), which all receive the same row delta.
+
+	Every cycle (start, update, sample reload) collects its stage timings and
+	counters in stats (aspectcsadjust_metrics.Stats), logs them, appends them
+	to metrics (a MetricsLog) if set and passes them to oncycle(stats)."""
+	def __init__(self, resultfile, samplefile, reportfile):
+		self.resultfile = resultfile
+		self.samplefile = samplefile
+		self.reportfile = reportfile
+		self.cancelled = threading.Event()
+		self.lock = threading.Lock()
+		self.watcher = None
+		self.ondata = None
+		self.ontimer = None
+		self.sampledata = Standards()
+		self.library = None
+		self.output_data = []
+		self.data = []
+		self.npending = 0
+		self.reader = ResultReader(resultfile)
+		self.reader.cancelled = self.cancelled
+		self.tracker = StandardTracker(self.sampledata)
+		self.writer = ReportWriter(reportfile)
+		self.sinks = []
+		self.detector = ChangeDetector()
+		self.checkpoint = {}
+		self.cache = None
+		self.metrics = None
+		self.oncycle = None
+		self.stats = Stats()
+		self.cycledepth = 0
+		self.reportfailed = False
+
+	def getexiting(self):
+		return self.cancelled.is_set()
+
+	def setexiting(self, value):
+		if value:
+			self.cancel()
+		else:
+			self.cancelled.clear()
+
+	exiting = property(getexiting, setexiting)
+
+	def cancel(self):
+		"""Stop the processing as soon as possible, from any thread."""
+		self.cancelled.set()
+		with self.lock:
+			if self.watcher is not None:
+				self.watcher.interrupt()
+
+	def checkcancel(self):
+		"""Raise Cancelled if the processing has been stopped."""
+		if self.cancelled.is_set():
+			raise Cancelled()
+
+	def checkfiles(self):
+		"""Check if result, sample and report files are OK."""
+		sample = samplefiles(self.samplefile)
+		if not os.path.isfile(self.resultfile) or len(sample) == 0 or not all(os.path.isfile(f) for f in sample):
+			return False
+		try:
+			f = open(self.reportfile,'a')
+			f.close()
+		except (IOError, OSError):
+			return False
+		return True
+
+	def start(self):
+		"""Load the standards and process the whole result file, or resume
+		from the cached state when the result file was only appended to."""
+		with self.cycle('start'):
+			self.startcycle()
+
+	def startcycle(self):
+		self.parsesample()
+		self.resetstate()
+		if self.loadcache():
+			# publish the cached report, then process what was appended since
+			with self.stats.timer('detect'):
+				self.detector.update(self.output_data)
+			self.publish(0)
+			self.update()
+		else:
+			self.processresult(self.parseresult())
+			self.savecache()
+
+	def resetstate(self):
+		"""Forget the result and report rows, the next pass starts over."""
+		self.reader.reset()
+		self.data = []
+		self.npending = 0
+		self.output_data = []
+		self.detector.reset()
+
+	def run(self, interval=UPDATE_DELAY):
+		"""Process the results until exiting is set.
+		A change of the watched files triggers a pass immediately; without
+		notifications the files are checked every interval seconds."""
+		try:
+			self.start()
+			sample = set(os.path.abspath(f) for f in samplefiles(self.samplefile))
+			result = os.path.abspath(self.resultfile)
+			watcher = FileWatcher([self.resultfile] + list(sample))
+			with self.lock:
+				self.watcher = watcher
+			log.info("Watching files ("+("polling" if watcher.polling else "inotify")+")")
+			counter=0
+			try:
+				while not self.cancelled.is_set():
+					changed = watcher.wait(1)
+					if self.cancelled.is_set():
+						break
+					if sample & changed:
+						self.reloadsample()
+						if result in changed:
+							# new results in the same burst: do not wait for the next pass
+							counter=0
+							self.update()
+					elif changed or counter>=interval:
+						counter=0
+						self.update()
+					else:
+						counter=counter+1
+					if self.ontimer is not None:
+						self.ontimer(counter)
+			finally:
+				with self.lock:
+					self.watcher = None
+					watcher.close()
+		except Cancelled:
+			log.info("Stopped")
+			return
+		self.savecache()
+
+	@contextmanager
+	def cycle(self, name):
+		"""Collect the Stats of a processing cycle; nested cycles belong to
+		the outermost one."""
+		if self.cycledepth == 0:
+			self.stats = Stats(name)
+			self.reader.stats = self.stats
+		self.cycledepth += 1
+		try:
+			yield self.stats
+		finally:
+			self.cycledepth -= 1
+			if self.cycledepth == 0:
+				self.endcycle()
+
+	def endcycle(self):
+		"""Report the Stats of the cycle just finished."""
+		stats = self.stats
+		stats.finish()
+		busy = stats.counters.get('rows_parsed') or 'report' in stats.timings
+		log.log(logging.INFO if busy else logging.DEBUG, stats.summary())
+		if self.metrics is not None:
+			try:
+				self.metrics.write(stats)
+			except (IOError, OSError) as e:
+				log.warning("Can not write the metrics file: "+str(e))
+				self.metrics = None
+		if self.oncycle is not None:
+			self.oncycle(stats)
+
+	def loadcache(self):
+		"""Resume from the cached state of the result file, if any.
+		Return whether the state was restored."""
+		if self.cache is None:
+			return False
+		try:
+			with self.stats.timer('cache'):
+				state = self.cache.load(self.resultfile, self.samplefile)
+		except Exception as e:
+			log.warning("Can not read the result cache: "+str(e))
+			return False
+		if state is None:
+			return False
+		st = os.stat(self.resultfile)
+		self.reader.offset = state['offset']
+		with self.stats.timer('read'):
+			crc = self.reader.prefixcrc(self.stats)
+		if crc != state.get('crc'):
+			# the cache fingerprint only hashes both ends of the file
+			log.info("Result file changed since it was cached, parsing it again")
+			self.reader.reset()
+			return False
+		self.reader.ident = (st.st_dev, st.st_ino)
+		self.reader.crc = crc
+		with self.stats.timer('read'):
+			self.reader.window = self.reader.windowcrc(self.stats)
+		self.reader.stat = (st.st_size, st.st_mtime)
+		self.reader.partial = state['partial']
+		self.reader.line_num = state['line_num']
+		self.reader.pending = state['pending']
+		self.data = state['data']
+		self.output_data = state['output']
+		self.checkpoint = state['checkpoint']
+		log.info("Resuming from the result cache ("+str(len(self.data))+" rows)")
+		return True
+
+	def savecache(self):
+		"""Save the state of the complete rows to the cache."""
+		complete = len(self.data) - self.npending
+		if self.cache is None or self.reader.ident is None or len(self.output_data) != len(self.data):
+			return
+		state = {
+			'offset': self.reader.offset,
+			'crc': self.reader.crc,
+			'partial': self.reader.partial,
+			'line_num': self.reader.line_num,
+			'pending': self.reader.pending,
+			'data': self.data[:complete],
+			'output': self.output_data[:complete],
+			'checkpoint': self.checkpoint,
+		}
+		try:
+			with self.stats.timer('cache'):
+				self.cache.store(self.resultfile, self.samplefile, state)
+		except Exception as e:
+			log.warning("Can not write the result cache: "+str(e))
+
+	def update(self):
+		"""Process what changed in the result file since the last pass."""
+		with self.cycle('update'):
+			if self.reportfailed:
+				self.writereport(self.output_data)
+			start = self.parseresult()
+			if start is not None:
+				self.processresult(start)
+			else:
+				log.debug("Results on disk did not change, skipping data processing!")
+
+	def parseresult(self):
+		"""Parse the new rows of result csv file.
+		Return the index of the first row that may have changed,
+		or None if the result data did not change."""
+		old_pending = self.data[len(self.data)-self.npending:]
+		try:
+			rows, reloaded = self.reader.read()
+		except csv.Error as e:
+			raise csv.Error('file %s, %s' % (self.resultfile, e))
+		if reloaded:
+			self.data = []
+		elif len(rows) == 0 and self.reader.pending == old_pending:
+			return None
+		elif self.npending:
+			del self.data[-self.npending:]
+		start = len(self.data)
+		self.data.extend(rows)
+		self.data.extend(self.reader.pending)
+		self.npending = len(self.reader.pending)
+		return start
+
+	def processresult(self, start=0):
+		"""Generate output reports in RAM based on latest result data.
+		Rows before start are unchanged and are not computed again;
+		start must be 0 or the number of complete rows of the previous run."""
+		if start == 0:
+			self.tracker.reset()
+		else:
+			self.tracker.restore(self.checkpoint)
+		del self.output_data[start:]
+		complete = len(self.data) - self.npending
+		stats = self.stats
+		self.tracker.matched = 0
+		try:
+			with stats.timer('process'):
+				for i in range(start, complete, CANCEL_ROWS):
+					self.checkcancel()
+					self.output_data.extend(self.tracker.processrows(self.data[i:min(i+CANCEL_ROWS, complete)]))
+				self.checkpoint = self.tracker.checkpoint()
+				self.output_data.extend(self.tracker.processrows(self.data[complete:]))
+				self.checkcancel()
+		except Cancelled:
+			self.resetstate()
+			raise
+		except:
+			log.error("Parsing error. Wrong input file format?")
+			self.exiting=True
+			raise
+		stats.count('standards_matched', self.tracker.matched)
+		stats.count('rows_computed', len(self.output_data)-start)
+
+		log.info("records in/out: "+str(len(self.data))+"/"+str(len(self.output_data))+" (computed "+str(len(self.output_data)-start)+")")
+		with stats.timer('detect'):
+			status, changed = self.detector.update(self.output_data[start:], start)
+		if status == ChangeDetector.UNCHANGED:
+			log.info("Same data, not regenerating csv report file")
+			return
+		if status == ChangeDetector.APPENDED:
+			log.info("appended "+str(len(self.output_data)-changed)+" rows")
+		else:
+			log.info("data changed from row "+str(changed))
+		self.publish(changed)
+
+	def publish(self, start):
+		"""Hand the report rows from start on to ondata and the report file."""
+		if self.ondata is not None:
+			with self.stats.timer('ondata'):
+				self.ondata(start, self.output_data[start:])
+		self.generatereport(self.output_data, start)
+
+	def parsesample(self):
+		"""Parse sample csv file(s)"""
+		with self.stats.timer('sample'):
+			self.library = StandardsLibrary(self.samplefile)
+		self.sampledata = self.library.standards
+		self.tracker = StandardTracker(self.sampledata)
+
+	def reloadsample(self):
+		"""Reload the sample csv files after a change and recompute the report
+		rows of the element lines whose standards changed. A broken sample
+		file is reported and the previous standards are kept."""
+		with self.cycle('sample'):
+			try:
+				with self.stats.timer('sample'):
+					affected = self.library.reload()
+			except (StandardsError, IOError, OSError) as e:
+				log.warning("Can not reload sample file, keeping previous standards: "+str(e))
+				return
+			if affected is not None and len(affected) == 0:
+				log.debug("Sample files unchanged")
+				return
+			self.sampledata = self.library.standards
+			self.tracker = StandardTracker(self.sampledata)
+			if affected is None:
+				log.info("Sample file changed, reprocessing results")
+				self.parseresult()
+				self.processresult(0)
+			else:
+				log.info("Standards of "+", ".join(sorted(affected))+" changed, recomputing their rows")
+				self.recomputelines(affected)
+
+	def recomputelines(self, lines):
+		"""Recompute the report rows of the given element lines only.
+		The standard names are unchanged, so is the governing standard of
+		every row: replaying the rows of these lines alone is enough."""
+		tracker = StandardTracker(self.sampledata)
+		first = None
+		computed = 0
+		with self.stats.timer('process'):
+			for i, row in enumerate(self.data):
+				if row.element in lines:
+					self.output_data[i] = tracker.processrow(row)
+					computed += 1
+					if first is None:
+						first = i
+		self.stats.count('standards_matched', tracker.matched)
+		self.stats.count('rows_computed', computed)
+		if first is None:
+			return
+		with self.stats.timer('detect'):
+			status, changed = self.detector.update(self.output_data[first:], first)
+		if status != ChangeDetector.UNCHANGED:
+			self.publish(changed)
+
+	def generatereport(self, data, start=0):
+		"""Dump report to disk in csv format, rows before start are unchanged"""
+		self.writereport(data, start)
+		for sink in self.sinks:
+			try:
+				with self.stats.timer('export'):
+					sink.write(data, start)
+			except Exception as e:
+				# an export failing (disk, database, pyarrow) must not stop the report
+				log.error("Can not export the report to "+sink.filename+": "+str(e))
+				continue
+			log.info("exported "+sink.filename+" ("+sink.last_mode+", "+str(sink.last_rows)+" rows)")
+
+	def writereport(self, data, start=0):
+		"""Write the report file. When it can not be written (held open by
+		another program on Windows) the previous report is kept and the next
+		update() tries again."""
+		try:
+			with self.stats.timer('report'):
+				self.writer.write(data, start)
+		except (IOError, OSError) as e:
+			log.error("Can not write the report, keeping the previous one: "+str(e))
+			self.reportfailed = True
+			return
+		self.reportfailed = False
+		self.stats.count('report_bytes', self.writer.last_bytes)
+		log.info("generated report! ("+self.writer.last_mode+", "+str(self.writer.last_rows)+" rows, "+str(self.writer.last_bytes)+" bytes)")
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+"""Instrumentation of the AspectCSAdjust pipeline: per cycle stage timings
+and counters, a JSON-lines metrics file and an optional cProfile hook.
+
+The metrics file and the profile can be enabled with the ASPECTCSADJUST_METRICS
+and ASPECTCSADJUST_PROFILE environment variables (file names), or with the
+--metrics and --profile command line options."""
+
+import os, sys, time, json, logging
+
+METRICS_ENV='ASPECTCSADJUST_METRICS'
+PROFILE_ENV='ASPECTCSADJUST_PROFILE'
+
+log = logging.getLogger('aspectcsadjust')
+
+class Timer(object):
+	"""Context manager adding the time spent in the block to a stage."""
+	def __init__(self, stats, stage):
+		self.stats = stats
+		self.stage = stage
+
+	def __enter__(self):
+		self.started = time.time()
+		return self
+
+	def __exit__(self, *args):
+		self.stats.add(self.stage, time.time() - self.started)
+
+class Stats(object):
+	"""Stage timings (seconds) and counters of one processing cycle."""
+	def __init__(self, cycle=''):
+		self.cycle = cycle
+		self.started = time.time()
+		self.seconds = None
+		self.timings = {}
+		self.counters = {}
+
+	def timer(self, stage):
+		return Timer(self, stage)
+
+	def add(self, stage, seconds):
+		self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+
+	def count(self, name, n=1):
+		self.counters[name] = self.counters.get(name, 0) + n
+
+	def finish(self):
+		"""Stop the cycle clock, return the total seconds."""
+		self.seconds = time.time() - self.started
+		return self.seconds
+
+	def record(self):
+		"""The cycle as a JSON serializable dict."""
+		record = {
+			'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+			'cycle': self.cycle,
+			'seconds': round(self.seconds or 0.0, 6),
+			'stages': dict((stage, round(seconds, 6)) for stage, seconds in self.timings.items()),
+		}
+		record.update(self.counters)
+		return record
+
+	def summary(self):
+		"""One line description of the cycle for the log."""
+		stages = ', '.join('%s %.1fms' % (stage, seconds * 1000) for stage, seconds in sorted(self.timings.items()))
+		counters = ', '.join('%s %d' % item for item in sorted(self.counters.items()))
+		return '%s cycle %.1fms (%s) %s' % (self.cycle, (self.seconds or 0.0) * 1000, stages, counters)
+
+class MetricsLog(object):
+	"""Append the records of the cycles to a JSON-lines file."""
+	def __init__(self, filename):
+		self.filename = filename
+
+	def write(self, stats):
+		with open(self.filename, 'a') as f:
+			f.write(json.dumps(stats.record(), sort_keys=True) + '\n')
+
+def metricsfromenv():
+	"""MetricsLog of the file named by ASPECTCSADJUST_METRICS, or None."""
+	filename = os.environ.get(METRICS_ENV)
+	return MetricsLog(filename) if filename else None
+
+def setuplogging(level=logging.INFO, stream=None):
+	"""Send the pipeline messages to stream (stdout), as plain lines."""
+	handler = logging.StreamHandler(stream or sys.stdout)
+	handler.setFormatter(logging.Formatter('%(message)s'))
+	log.addHandler(handler)
+	log.setLevel(level)
+
+def profiled(func, filename=None):
+	"""Call func() under cProfile when filename (default: the
+	ASPECTCSADJUST_PROFILE variable) is set, saving the statistics there
+	for pstats / snakeviz. Return what func() returns."""
+	filename = filename or os.environ.get(PROFILE_ENV)
+	if not filename:
+		return func()
+	import cProfile
+	profile = cProfile.Profile()
+	try:
+		return profile.runcall(func)
+	finally:
+		profile.dump_stats(filename)
+		log.info("profile saved to "+filename)
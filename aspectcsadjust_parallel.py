@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+"""Parallel parsing of large result files (archives).
+
+The file is split at line boundaries into byte ranges; worker processes
+read, sanitize, parse and normalize one range each, and the ResultRow
+objects are merged back in file order. The standards pass stays
+sequential, over the parsed rows. See ResultReader.workers."""
+
+import os
+from aspectcsadjust_core import *
+from aspectcsadjust_batch import cpucount
+try:
+	from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+	ProcessPoolExecutor = None
+
+PARALLEL_CHUNK=4<<20	# smallest byte range given to a worker
+PARALLEL_SPLIT=4	# ranges per worker, to even out the load
+
+def lastnewline(f, size):
+	"""Offset just after the last newline in the first size bytes of the
+	binary file f, 0 if there is none."""
+	end = size
+	while end > 0:
+		start = max(0, end - STREAM_BLOCK)
+		f.seek(start)
+		found = f.read(end - start).rfind(b'\n')
+		if found >= 0:
+			return start + found + 1
+		end = start
+	return 0
+
+def splitranges(filename, size, nranges):
+	"""Up to nranges (start, end) byte ranges covering the complete lines
+	of the first size bytes of filename, each one starting on a line."""
+	with open(filename, 'rb') as f:
+		end = lastnewline(f, size)
+		bounds = [0]
+		for k in range(1, nranges):
+			f.seek(max(end * k // nranges, bounds[-1]))
+			f.readline()
+			pos = f.tell()
+			if pos >= end:
+				break
+			if pos > bounds[-1]:
+				bounds.append(pos)
+	return [(start, stop) for start, stop in zip(bounds, bounds[1:] + [end]) if start < stop]
+
+def parserange(job):
+	"""Worker: ResultRow objects of the (filename, start, end) byte range.
+	Return (rows, lines, dropped), or None if the range is malformed: the
+	caller parses serially to report the error with its line number."""
+	filename, start, end = job
+	with open(filename, 'rb') as f:
+		f.seek(start)
+		data = f.read(end - start)
+	reader = ResultReader(filename)
+	try:
+		rows = reader.parselines(splitlines(asciitext(cleanbytes(data))))
+	except csv.Error:
+		return None
+	return rows, reader.line_num, reader.dropped
+
+def parseranges(filename, size, workers=None, cancelled=None, minchunk=PARALLEL_CHUNK):
+	"""Parse the complete lines of the first size bytes of filename in
+	parallel, in ranges of minchunk bytes at least. Return (rows, end, lines, dropped): rows in file order, the
+	offset after the last parsed line, the lines and the dropped rows, or
+	None if the file must be parsed serially (malformed csv, or no
+	process pool). Raises Cancelled when cancelled (an Event) is set."""
+	workers = workers or cpucount()
+	if ProcessPoolExecutor is None:
+		return None
+	nranges = max(1, min(workers * PARALLEL_SPLIT, size // minchunk))
+	ranges = splitranges(filename, size, nranges)
+	if len(ranges) == 0:
+		return None
+	rows = []
+	lines = 0
+	dropped = 0
+	with ProcessPoolExecutor(max_workers=min(workers, len(ranges))) as executor:
+		for result in executor.map(parserange, [(filename, start, end) for start, end in ranges]):
+			if cancelled is not None and cancelled.is_set():
+				raise Cancelled()
+			if result is None:
+				return None
+			rows.extend(result[0])
+			lines += result[1]
+			dropped += result[2]
+	return rows, ranges[-1][1], lines, dropped
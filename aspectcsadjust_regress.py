@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+"""Regression harness: compare the single pass StandardTracker with the
+original backward scan of WorkingThread.processresult on synthetic files,
+and the incremental Pipeline updates with a full run on the same file.
+
+Usage: python aspectcsadjust_regress.py [rows ...]"""
+
+import sys, os, re, csv, random, shutil, tempfile
+from aspectcsadjust_core import *
+from aspectcsadjust_synth import *
+
+def legacyprocess(data, sampledata):
+	"""Original quadratic algorithm, kept verbatim as reference."""
+	output_data = []
+	for row in data:
+		output_data.append([row[RES_NUM_COL],row[RES_NAME_COL],row[RES_LINE_COL].strip("1234567890 "),0,' ',row[RES_NAME2_COL],row[RES_POS_COL],row[RES_ABS_COL],row[RES_DATE_COL],row[RES_TIME_COL]])
+		data_upto_here = list(data[0:len(output_data)])
+		rrow_is_also_current_row=True
+		current_row_is_standard=False
+		standard_found=False
+		standard_conc=0
+		standard_abs=1
+		standard_dilut=1
+		row_stripped_line=row[RES_LINE_COL].strip("1234567890 ")
+		for rrow in reversed(data_upto_here):
+			for standardrow in sampledata:
+				if rrow[RES_NAME_COL].strip()==standardrow[SAM_NAME_COL].strip():
+					if rrow_is_also_current_row==True:
+						current_row_is_standard=True
+						break
+					if row_stripped_line==rrow[RES_LINE_COL].strip("1234567890 "):
+						for nest_stdrow in sampledata:
+							if row_stripped_line==nest_stdrow[SAM_LINE_COL].strip() and standardrow[SAM_NAME_COL].strip()==nest_stdrow[SAM_NAME_COL].strip():
+								standard_conc=float(nest_stdrow[SAM_CONC_COL])
+								break
+						standard_abs=float(rrow[RES_ABS_COL])
+						if(rrow[RES_NAME2_COL].strip()!=''):
+							standard_dilut=float(rrow[RES_NAME2_COL])
+						standard_found=True
+						break
+			rrow_is_also_current_row=False
+			if current_row_is_standard or standard_found==True:
+				break
+		if standard_found==True:
+			if standard_abs == 0:
+				a = 0
+			else:
+				a = ( standard_conc * float(row[RES_ABS_COL]) ) / standard_abs
+			try:
+				b = float(row[RES_NAME2_COL]) / standard_dilut
+			except:
+				b = 0
+			output_data[-1][REP_CONC_COL]= a * b
+	return output_data
+
+def reportbytes(filename, data):
+	"""Write data the way generatereport does and return the file content."""
+	if sys.version_info >= (3,0,0):
+		report = open(filename, 'w', newline='')
+	else:
+		report = open(filename, 'wb')
+	with report:
+		writer = csv.writer(report, delimiter=';', quotechar='"', quoting=csv.QUOTE_ALL)
+		writer.writerows(data)
+	with open(filename, 'rb') as f:
+		return f.read()
+
+def compare(nrows, seed=0, std_ratio=0.1):
+	"""Generate a synthetic result set and compare both algorithms.
+	Return the number of report rows checked, raise AssertionError on mismatch."""
+	tmpdir = tempfile.mkdtemp(prefix='aspectcsadjust')
+	try:
+		resultfile = os.path.join(tmpdir, 'Result.csv')
+		samplefile = os.path.join(tmpdir, 'Defstd.alv')
+		writeresult(resultfile, resultrows(nrows, std_ratio=std_ratio, seed=seed), seed=seed)
+		writestandards(samplefile, standardrows(seed=seed))
+		data = readresult(resultfile)
+		sampledata = readsample(samplefile)
+		expected = reportbytes(os.path.join(tmpdir, 'Expected.csv'), legacyprocess(data, sampledata))
+		actual = reportbytes(os.path.join(tmpdir, 'Report.csv'), StandardTracker(Standards(sampledata)).processrows(data))
+		if expected != actual:
+			for n, (e, a) in enumerate(zip(expected.splitlines(), actual.splitlines())):
+				if e != a:
+					raise AssertionError('rows=%d seed=%d: report differs at line %d\n- %r\n+ %r' % (nrows, seed, n + 1, e, a))
+			raise AssertionError('rows=%d seed=%d: report length differs' % (nrows, seed))
+		return len(data)
+	finally:
+		shutil.rmtree(tmpdir)
+
+def readbytes(filename):
+	"""Content of filename, None if it does not exist (no report yet)."""
+	if not os.path.exists(filename):
+		return None
+	with open(filename, 'rb') as f:
+		return f.read()
+
+def fullreport(resultfile, samplefile, reportfile):
+	"""Report bytes of a full run of a new Pipeline."""
+	if os.path.exists(reportfile):
+		os.remove(reportfile)
+	Pipeline(resultfile, samplefile, reportfile).start()
+	return readbytes(reportfile)
+
+def compareincremental(nrows, seed=0, std_ratio=0.1):
+	"""Feed a result file to a Pipeline the way the instrument does (appends
+	in random chunks, cutting lines), then rewrite a row in place and copy
+	another file over it; after every step the report must be the one of a
+	full run. Return the number of updates checked, raise AssertionError."""
+	tmpdir = tempfile.mkdtemp(prefix='aspectcsadjust')
+	try:
+		resultfile = os.path.join(tmpdir, 'Result.csv')
+		samplefile = os.path.join(tmpdir, 'Defstd.alv')
+		reportfile = os.path.join(tmpdir, 'Report.csv')
+		sourcefile = os.path.join(tmpdir, 'Source.csv')
+		writestandards(samplefile, standardrows(seed=seed))
+		writeresult(sourcefile, resultrows(nrows, std_ratio=std_ratio, seed=seed), seed=seed)
+		with open(sourcefile, 'rb') as f:
+			content = f.read()
+		rnd = random.Random(seed)
+		offset = rnd.randint(0, len(content) // 2)
+		with open(resultfile, 'wb') as f:
+			f.write(content[:offset])
+		pipeline = Pipeline(resultfile, samplefile, reportfile)
+		pipeline.start()
+		updates = 0
+		def check(step):
+			pipeline.update()
+			if readbytes(reportfile) != fullreport(resultfile, samplefile, os.path.join(tmpdir, 'Expected.csv')):
+				raise AssertionError('rows=%d seed=%d: incremental report differs after %s' % (nrows, seed, step))
+		while offset < len(content):
+			end = min(len(content), offset + rnd.randint(1, max(1, len(content) // 10)))
+			with open(resultfile, 'ab') as f:
+				f.write(content[offset:end])
+			offset = end
+			check('an append')
+			updates += 1
+		# the absorbance of a row rewritten in place: same inode, same size
+		lines = content.split(b'\n')
+		n = rnd.choice([i for i, line in enumerate(lines) if line.count(b';') > RES_ABS_COL])
+		fields = lines[n].split(b';')
+		fields[RES_ABS_COL] = re.sub(b'[0-9]', b'7', fields[RES_ABS_COL])
+		lines[n] = b';'.join(fields)
+		with open(resultfile, 'r+b') as f:
+			f.write(b'\n'.join(lines))
+		check('an in-place rewrite')
+		# another (larger) file copied over, keeping the inode
+		writeresult(sourcefile, resultrows(nrows * 2, std_ratio=std_ratio, seed=seed + 1), seed=seed + 1)
+		shutil.copyfile(sourcefile, resultfile)
+		check('an overwrite by copy')
+		return updates + 2
+	finally:
+		shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+	sizes = [int(arg) for arg in sys.argv[1:]] or [10, 100, 1000, 3000]
+	for nrows in sizes:
+		for seed in range(3):
+			for std_ratio in (0.02, 0.1, 0.5):
+				checked = compare(nrows, seed, std_ratio)
+				print('OK rows=%d seed=%d standards=%.2f (%d report rows)' % (nrows, seed, std_ratio, checked))
+			checked = compareincremental(nrows, seed)
+			print('OK rows=%d seed=%d incremental (%d updates)' % (nrows, seed, checked))
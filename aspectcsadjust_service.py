@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+"""Service mode: the live report rows served on a local socket (Python 3).
+
+The Pipeline watches the result file in a worker thread, as in --watch,
+while an asyncio server answers the clients of a Unix socket (or of a
+localhost TCP port). The protocol is JSON-lines: one request object per
+line, one reply object per line. Rows are objects with the REPORT_COLUMNS
+keys. Requests:
+
+	{"op": "subscribe"}		reply, then the current rows as a "rows" event,
+					then one "rows" event per change
+	{"op": "unsubscribe"}
+	{"op": "range", "start": 0, "end": 100}	rows from start to end (excluded)
+	{"op": "find", "numero": "123"}		rows with that measurement number
+	{"op": "info"}			row count, files and the last cycle metrics
+
+A "rows" event {"event": "rows", "start": K, "count": N, "rows": [...]}
+means: the rows from K on are replaced by rows, the report has N rows."""
+
+import os, json, signal, socket, asyncio, logging
+from aspectcsadjust_core import *
+from aspectcsadjust_sinks import REPORT_COLUMNS, rowobject
+
+SERVICE_SOCKET='aspectcsadjust.sock'	# in the configuration folder
+SERVICE_PORT=8765	# localhost port where Unix sockets are not available
+SUBSCRIBER_BUFFER=8<<20	# bytes queued for a subscriber before it is dropped
+
+log = logging.getLogger('aspectcsadjust')
+
+def encode(message):
+	return (json.dumps(message) + '\n').encode('utf-8')
+
+class ResultService(object):
+	"""The report rows of a Pipeline, kept in memory and indexed by
+	measurement number, published to the subscribed clients."""
+	def __init__(self, pipeline, loop):
+		self.pipeline = pipeline
+		self.loop = loop
+		self.rows = []
+		self.numbers = {}	# measurement number -> row positions
+		self.subscribers = set()
+		self.clients = set()
+		self.stats = None
+		pipeline.ondata = self.ondata
+		pipeline.oncycle = self.oncycle
+
+	def ondata(self, start, rows):
+		"""Pipeline callback, called from the worker thread."""
+		self.loop.call_soon_threadsafe(self.publish, start, rows)
+
+	def oncycle(self, stats):
+		self.stats = stats.record()
+
+	def publish(self, start, rows):
+		"""Apply the delta to the rows and push it to the subscribers."""
+		for i in range(start, len(self.rows)):
+			number = self.rows[i][REP_NUM_COL].strip()
+			positions = self.numbers[number]
+			positions.remove(i)
+			if not positions:
+				del self.numbers[number]
+		del self.rows[start:]
+		for i, row in enumerate(rows, start):
+			self.numbers.setdefault(row[REP_NUM_COL].strip(), []).append(i)
+		self.rows.extend(rows)
+		if self.subscribers:
+			message = encode(self.event(start))
+			for writer in list(self.subscribers):
+				self.send(writer, message)
+
+	def event(self, start):
+		return {'event': 'rows', 'start': start, 'count': len(self.rows), 'rows': [rowobject(row) for row in self.rows[start:]]}
+
+	def send(self, writer, data):
+		"""Queue data for a client; clients not reading are dropped instead
+		of buffering without limits."""
+		if writer.transport.is_closing():
+			self.subscribers.discard(writer)
+		elif writer.transport.get_write_buffer_size() > SUBSCRIBER_BUFFER:
+			log.warning("Dropping a client not reading its events")
+			self.subscribers.discard(writer)
+			writer.close()
+		else:
+			writer.write(data)
+
+	async def handle(self, reader, writer):
+		"""Serve the requests of one client."""
+		self.clients.add(writer)
+		try:
+			while True:
+				line = await reader.readline()
+				if not line:
+					break
+				try:
+					reply = self.request(json.loads(line.decode('utf-8')), writer)
+				except (ValueError, KeyError, TypeError) as e:
+					reply = {'ok': False, 'error': str(e)}
+				self.send(writer, encode(reply))
+				if reply.get('op') == 'subscribe':
+					self.send(writer, encode(self.event(0)))
+				await writer.drain()
+		except (ConnectionError, ValueError):
+			pass	# connection lost, or request line over the stream limit
+		finally:
+			self.subscribers.discard(writer)
+			self.clients.discard(writer)
+			writer.close()
+
+	def close(self):
+		"""Disconnect all the clients."""
+		for writer in list(self.clients):
+			writer.close()
+
+	def request(self, request, writer):
+		"""Reply to a request object."""
+		if not isinstance(request, dict):
+			raise ValueError('the request must be a JSON object')
+		op = request.get('op')
+		if op == 'subscribe':
+			self.subscribers.add(writer)
+			return {'ok': True, 'op': op}
+		if op == 'unsubscribe':
+			self.subscribers.discard(writer)
+			return {'ok': True, 'op': op}
+		if op == 'range':
+			start = max(0, int(request.get('start', 0)))
+			end = int(request.get('end', len(self.rows)))
+			return {'ok': True, 'op': op, 'start': start, 'count': len(self.rows), 'rows': [rowobject(row) for row in self.rows[start:end]]}
+		if op == 'find':
+			number = str(request['numero']).strip()
+			positions = self.numbers.get(number, [])
+			return {'ok': True, 'op': op, 'positions': positions, 'rows': [rowobject(self.rows[i]) for i in positions]}
+		if op == 'info':
+			return {'ok': True, 'op': op, 'count': len(self.rows), 'columns': REPORT_COLUMNS, 'result': self.pipeline.resultfile, 'sample': self.pipeline.samplefile, 'report': self.pipeline.reportfile, 'subscribers': len(self.subscribers), 'last_cycle': self.stats}
+		raise ValueError('unknown op %r' % op)
+
+def defaultaddress():
+	"""Unix socket in the configuration folder, or the localhost port."""
+	if hasattr(socket, 'AF_UNIX'):
+		return os.path.join(configdir(), SERVICE_SOCKET)
+	return str(SERVICE_PORT)
+
+async def startserver(handler, address):
+	"""Listen on address: a port number (localhost) or a Unix socket path."""
+	if address.isdigit():
+		return await asyncio.start_server(handler, '127.0.0.1', int(address))
+	if os.path.exists(address):
+		os.remove(address)	# left over by a previous run
+	return await asyncio.start_unix_server(handler, address)
+
+async def runservice(pipeline, address, interval):
+	loop = asyncio.get_running_loop()
+	service = ResultService(pipeline, loop)
+	server = await startserver(service.handle, address)
+	log.info("Serving results on "+address)
+	stop = asyncio.Event()
+	for signum in (signal.SIGINT, signal.SIGTERM):
+		try:
+			loop.add_signal_handler(signum, stop.set)
+		except (NotImplementedError, RuntimeError):
+			pass	# Windows: Ctrl+C raises KeyboardInterrupt
+	worker = loop.run_in_executor(None, pipeline.run, interval)
+	stopping = asyncio.ensure_future(stop.wait())
+	try:
+		await asyncio.wait([worker, stopping], return_when=asyncio.FIRST_COMPLETED)
+	finally:
+		pipeline.cancel()
+		stopping.cancel()
+		server.close()
+		service.close()
+		await server.wait_closed()
+		if not address.isdigit() and os.path.exists(address):
+			os.remove(address)
+		await worker	# raises the errors of the pipeline
+
+def serve(pipeline, address=None, interval=UPDATE_DELAY):
+	"""Watch the result file and serve its report rows until interrupted."""
+	asyncio.run(runservice(pipeline, address or defaultaddress(), interval))
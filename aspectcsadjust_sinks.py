@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""Report sinks: the same report rows exported in other formats.
+
+A sink has write(data, start), which brings the sink in line with the
+report rows in data knowing that the rows before start did not change
+since the previous call (only data[start:] is new), and close(). The
+CSV report itself is the ReportWriter of aspectcsadjust_core. The format
+of a sink is chosen from the file extension, see opensink()."""
+
+import os, json
+from collections import OrderedDict
+from aspectcsadjust_core import *
+try:
+	import sqlite3
+except ImportError:
+	sqlite3 = None
+
+# output_data format: ("Numero,Nome,Elemento,Concentrazione,KAL,Diluizione,Posizione,Assorbanza,Data,Ora")
+REPORT_COLUMNS=['numero', 'nome', 'elemento', 'concentrazione', 'kal', 'diluizione', 'posizione', 'assorbanza', 'data', 'ora']
+
+def rowobject(row):
+	"""A report row as a JSON object with the REPORT_COLUMNS keys."""
+	return OrderedDict(zip(REPORT_COLUMNS, row))
+
+class JsonLinesSink(ReportWriter):
+	"""Report as JSON-lines, one object per row with the REPORT_COLUMNS keys.
+	New rows are appended, other changes rewrite the file atomically."""
+	def formatrows(self, rows):
+		lines = [json.dumps(rowobject(row)) for row in rows]
+		return ('\n'.join(lines) + '\n').encode('utf-8')
+
+class SqliteSink(object):
+	"""Report in a SQLite table (report by default), one record per row
+	keyed by its position. Each write() replaces the rows from start on in
+	a single transaction, inserting the new ones with executemany()."""
+	def __init__(self, filename, table='report'):
+		if sqlite3 is None:
+			raise ImportError('the SQLite export needs the sqlite3 module')
+		self.filename = filename
+		self.table = table
+		self.rows = None	# rows in the table, None if unknown
+		self.last_mode = ''
+		self.last_rows = 0
+		self.last_bytes = 0
+		columns = ', '.join('%s %s' % (name, 'REAL' if col == REP_CONC_COL else 'TEXT') for col, name in enumerate(REPORT_COLUMNS))
+		try:
+			self.db = sqlite3.connect(filename, check_same_thread=False)
+			with self.db:
+				self.db.execute('CREATE TABLE IF NOT EXISTS %s (row INTEGER PRIMARY KEY, %s)' % (table, columns))
+		except sqlite3.Error as e:
+			raise IOError('%s: %s' % (filename, e))
+
+	def write(self, data, start=0):
+		if self.rows is None:
+			start = 0
+		self.last_mode = 'append' if start == self.rows else 'update'
+		self.rows = None
+		insert = 'INSERT INTO %s VALUES (?%s)' % (self.table, ', ?' * len(REPORT_COLUMNS))
+		with self.db:
+			self.db.execute('DELETE FROM %s WHERE row >= ?' % self.table, (start,))
+			self.db.executemany(insert, ([i] + row for i, row in enumerate(data[start:], start)))
+		self.rows = len(data)
+		self.last_rows = len(data) - start
+
+	def close(self):
+		self.db.close()
+
+class ArrowSink(object):
+	"""Columnar export of the report with pyarrow (optional dependency):
+	Parquet for a .parquet file, Arrow IPC (Feather) otherwise. Both are
+	written whole, from columns updated with the new rows only."""
+	def __init__(self, filename):
+		try:
+			import pyarrow
+		except ImportError:
+			raise ImportError('the Parquet/Arrow export needs pyarrow')
+		self.pa = pyarrow
+		self.filename = filename
+		self.columns = None	# one list per column, None if unknown
+		self.last_mode = ''
+		self.last_rows = 0
+		self.last_bytes = 0
+
+	def write(self, data, start=0):
+		columns = self.columns
+		self.columns = None
+		if columns is None:
+			columns = [[] for name in REPORT_COLUMNS]
+			start = 0
+		for col, values in enumerate(columns):
+			del values[start:]
+			values.extend(row[col] for row in data[start:])
+		arrays = [self.pa.array([float(v) for v in values], type=self.pa.float64()) if col == REP_CONC_COL else self.pa.array(values, type=self.pa.string()) for col, values in enumerate(columns)]
+		table = self.pa.Table.from_arrays(arrays, names=REPORT_COLUMNS)
+		with replacing(self.filename) as tmpname:
+			if self.filename.lower().endswith('.parquet'):
+				import pyarrow.parquet
+				pyarrow.parquet.write_table(table, tmpname)
+			else:
+				import pyarrow.feather
+				pyarrow.feather.write_feather(table, tmpname)
+		self.columns = columns
+		self.last_mode = 'rewrite'
+		self.last_rows = len(data) - start
+		self.last_bytes = os.path.getsize(self.filename)
+
+	def close(self):
+		pass
+
+SINKS = [
+	(('.csv',), ReportWriter),
+	(('.jsonl', '.ndjson'), JsonLinesSink),
+	(('.sqlite', '.sqlite3', '.db'), SqliteSink),
+	(('.parquet', '.arrow', '.feather'), ArrowSink),
+]
+
+def opensink(filename):
+	"""Sink writing filename, in the format of its extension.
+	Raises ValueError for unknown extensions, ImportError when the
+	format needs a missing module."""
+	extension = os.path.splitext(filename)[1].lower()
+	for extensions, sink in SINKS:
+		if extension in extensions:
+			return sink(filename)
+	raise ValueError('unknown export format %r, use one of %s' % (filename, ', '.join(e for extensions, sink in SINKS for e in extensions)))
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+"""Synthetic Aspect CS Result.csv / Defstd.alv generators."""
+
+import random, csv, sys
+from aspectcsadjust_core import *
+
+RES_FILE_COLS=46
+ELEMENTS=['Cu', 'Fe', 'Zn', 'Pb', 'Cd', 'Mn', 'Ni', 'Cr']
+STANDARDS=['STD1', 'STD2', 'STD3', 'CAL A']
+
+def standardrows(elements=ELEMENTS, standards=STANDARDS, seed=0):
+	"""Rows of a synthetic Defstd.alv (name, line, conc, abs, dilution).
+	The last standard has no concentration for the last element on purpose."""
+	rnd = random.Random(seed)
+	rows = []
+	for name in standards:
+		for element in elements:
+			if name == standards[-1] and element == elements[-1]:
+				continue
+			rows.append([name, element, '%.3f' % rnd.uniform(0.1, 50), '%.4f' % rnd.uniform(0.05, 1.5), '1'])
+	return rows
+
+def resultrows(nrows, elements=ELEMENTS, standards=STANDARDS, std_ratio=0.1, seed=0):
+	"""Synthetic result rows in the 46 columns Result.csv layout."""
+	rnd = random.Random(seed)
+	rows = []
+	for i in range(nrows):
+		row = [''] * RES_FILE_COLS
+		row[RES_NUM_COL] = str(i + 1)
+		element = rnd.choice(elements)
+		row[RES_LINE_COL] = rnd.choice(['%s %d' % (element, rnd.randint(1, 3)), '%s%d' % (element, rnd.randint(1, 3)), element])
+		if rnd.random() < std_ratio:
+			row[RES_NAME_COL] = rnd.choice(standards) + rnd.choice(['', ' '])
+			absorbance = rnd.choice([0, rnd.uniform(0.05, 1.5)])
+			row[RES_NAME2_COL] = rnd.choice(['', '1', '2', '0.5'])
+		else:
+			row[RES_NAME_COL] = 'Sample %d' % rnd.randint(1, 500)
+			absorbance = rnd.uniform(-0.01, 2)
+			row[RES_NAME2_COL] = rnd.choice(['', '1', '5', '10', '0', '2.5'])
+		row[RES_ABS_COL] = '%.4f' % absorbance
+		row[RES_DATE_COL] = '%02d/10/2012' % (1 + i // 2000 % 28)
+		row[RES_TIME_COL] = '%02d:%02d:%02d' % (i // 3600 % 24, i // 60 % 60, i % 60)
+		row[RES_POS_COL] = str(rnd.randint(1, 120))
+		for col in range(3, RES_FILE_COLS - 1):
+			if row[col] == '' and col not in (RES_NAME2_COL, RES_POS_COL):
+				row[col] = '%.3f' % rnd.random()
+		rows.append(row)
+	return rows
+
+def writestandards(filename, rows):
+	"""Write a Defstd.alv file."""
+	with open(filename, 'w') as f:
+		writer = csv.writer(f, lineterminator='\n')
+		writer.writerows(rows)
+
+def writeresult(filename, rows, short_ratio=0.05, highbyte_ratio=0.01, junk_ratio=0.001, seed=0, append=False):
+	"""Write a Result.csv file the way the instrument does: freetext header
+	(unless appending), some 43 columns rows, a few high-byte characters
+	and freetext junk lines."""
+	rnd = random.Random(seed)
+	with open(filename, 'ab' if append else 'wb') as f:
+		if not append:
+			f.write(u'Aspect CS µ-Result export\r\nMethod;AAS äö\r\n\r\n'.encode('utf-8'))
+		for row in rows:
+			if rnd.random() < short_ratio:
+				row = row[0:32] + row[35:]
+			line = ';'.join(row)
+			if rnd.random() < highbyte_ratio:
+				line = line.replace(';', u'°;', 1)
+			if rnd.random() < junk_ratio:
+				f.write(u'Kalibrierung ändern / recalibration\0\r\n'.encode('utf-8'))
+			f.write((line + '\r\n').encode('utf-8'))
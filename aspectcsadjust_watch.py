@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+"""File change notification for AspectCSAdjust: inotify on Linux,
+polling of mtime/size everywhere else. A wait can be interrupted at
+once from another thread with FileWatcher.interrupt()."""
+
+import sys, os, time, select, struct, logging, threading
+
+DEBOUNCE_DELAY=0.2	# seconds without writes that close a burst
+DEBOUNCE_MAX=2.0	# never delay a burst longer than this
+POLL_INTERVAL=0.25
+
+IN_MODIFY=0x00000002
+IN_CLOSE_WRITE=0x00000008
+IN_MOVED_FROM=0x00000040
+IN_MOVED_TO=0x00000080
+IN_CREATE=0x00000100
+IN_DELETE=0x00000200
+IN_NONBLOCK=0o4000
+IN_CLOEXEC=0o2000000
+IN_WATCH_MASK=IN_MODIFY|IN_CLOSE_WRITE|IN_MOVED_FROM|IN_MOVED_TO|IN_CREATE|IN_DELETE
+IN_EVENT=struct.Struct('iIII')
+
+class PollWatcher(object):
+	"""Detect file changes by comparing size, mtime and inode."""
+	polling = True
+
+	def __init__(self, filenames):
+		self.filenames = [os.path.abspath(f) for f in filenames]
+		self.state = self.snapshot()
+		self.wakeup = threading.Event()
+
+	def snapshot(self):
+		state = {}
+		for filename in self.filenames:
+			try:
+				st = os.stat(filename)
+				state[filename] = (st.st_size, st.st_mtime, st.st_ino)
+			except OSError:
+				state[filename] = None
+		return state
+
+	def changes(self, timeout):
+		"""Files changed since the previous call, waiting up to timeout seconds."""
+		deadline = time.time() + timeout
+		while True:
+			state = self.snapshot()
+			changed = set(f for f in self.filenames if state[f] != self.state[f])
+			self.state = state
+			remaining = deadline - time.time()
+			if changed or remaining <= 0 or self.wakeup.is_set():
+				return changed
+			self.wakeup.wait(min(POLL_INTERVAL, remaining))
+
+	def interrupt(self):
+		"""Make the current and next changes() return immediately."""
+		self.wakeup.set()
+
+	def close(self):
+		pass
+
+class InotifyWatcher(object):
+	"""Detect file changes with Linux inotify (through ctypes).
+	The parent directories are watched, so replaced files are noticed too."""
+	polling = False
+
+	def __init__(self, filenames):
+		import ctypes, ctypes.util
+		self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+		self.filenames = [os.path.abspath(f) for f in filenames]
+		self.fd = self.libc.inotify_init1(IN_NONBLOCK|IN_CLOEXEC)
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+		# self pipe: interrupt() writes to it to wake up select()
+		self.wakeup, self.wakeupw = os.pipe()
+		self.dirs = {}
+		for directory in set(os.path.dirname(f) for f in self.filenames):
+			wd = self.libc.inotify_add_watch(self.fd, directory.encode(sys.getfilesystemencoding()), IN_WATCH_MASK)
+			if wd < 0:
+				err = ctypes.get_errno()
+				self.close()
+				raise OSError(err, 'inotify_add_watch failed on %s' % directory)
+			self.dirs[wd] = directory
+
+	def changes(self, timeout):
+		"""Files changed since the previous call, waiting up to timeout seconds.
+		The events of the other files of the watched directories (the report
+		and its temporary file, for instance) do not end the wait."""
+		deadline = time.time() + timeout
+		changed = set()
+		while True:
+			readable, _, _ = select.select([self.fd, self.wakeup], [], [], max(deadline - time.time(), 0))
+			if self.wakeup in readable or self.fd not in readable:
+				return changed
+			try:
+				buf = os.read(self.fd, 65536)
+			except OSError:
+				buf = b''
+			pos = 0
+			while pos + IN_EVENT.size <= len(buf):
+				wd, mask, cookie, length = IN_EVENT.unpack_from(buf, pos)
+				name = buf[pos+IN_EVENT.size:pos+IN_EVENT.size+length].rstrip(b'\0')
+				pos += IN_EVENT.size + length
+				if wd in self.dirs and name:
+					filename = os.path.join(self.dirs[wd], name.decode(sys.getfilesystemencoding()))
+					if filename in self.filenames:
+						changed.add(filename)
+			if changed or time.time() >= deadline:
+				return changed
+
+	def interrupt(self):
+		"""Make the current and next changes() return immediately."""
+		os.write(self.wakeupw, b'x')
+
+	def close(self):
+		if self.fd >= 0:
+			os.close(self.fd)
+			os.close(self.wakeup)
+			os.close(self.wakeupw)
+			self.fd = -1
+
+class FileWatcher(object):
+	"""Wait for changes of a set of files, collapsing a burst of writes
+	into a single notification. Uses inotify when available and polling
+	otherwise (see the polling attribute)."""
+	def __init__(self, filenames, debounce=DEBOUNCE_DELAY):
+		self.debounce = debounce
+		self.backend = None
+		if sys.platform.startswith('linux'):
+			try:
+				self.backend = InotifyWatcher(filenames)
+			except (OSError, AttributeError) as e:
+				logging.getLogger('aspectcsadjust').warning("inotify not available, polling files: "+str(e))
+		if self.backend is None:
+			self.backend = PollWatcher(filenames)
+		self.polling = self.backend.polling
+		self.interrupted = False
+
+	def interrupt(self):
+		"""Wake up wait() at once, also when called from another thread.
+		Every later wait() returns immediately too."""
+		self.interrupted = True
+		self.backend.interrupt()
+
+	def wait(self, timeout):
+		"""Block up to timeout seconds for a change, then until the writes
+		settle down. Return the set of changed (absolute) file names."""
+		changed = self.backend.changes(timeout)
+		if changed:
+			deadline = time.time() + DEBOUNCE_MAX
+			while time.time() < deadline and not self.interrupted:
+				more = self.backend.changes(self.debounce)
+				if not more:
+					break
+				changed |= more
+		return changed
+
+	def close(self):
+		self.backend.close()